@@ -0,0 +1,103 @@
+"""
+Настройки gunicorn: gunicorn -c config/gunicorn.py config.wsgi:application
+
+Все параметры задаются переменными окружения (или .env) через decouple.
+GUNICORN_PROFILE выбирает значения по умолчанию:
+
+    cpu - потоковые воркеры gthread, по 2 * CPU + 1 процесса;
+    io  - воркеры gevent для страниц, которые в основном ждут Stripe
+          (оплата, сохраненные карты): в каждом процессе обслуживаются
+          до GUNICORN_WORKER_CONNECTIONS запросов одновременно.
+
+С gevent каждый одновременный запрос держит свое соединение с базой,
+поэтому GUNICORN_WORKERS * GUNICORN_WORKER_CONNECTIONS не должно
+превышать max_connections postgres (или размер пула pgbouncer).
+"""
+import os
+
+# Имя config занято настройкой gunicorn (путь к этому файлу).
+from decouple import config as env
+
+
+def _cpu_count():
+    # В контейнере число доступных процессу ядер может быть меньше os.cpu_count().
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+PROFILES = {
+    'cpu': {'worker_class': 'gthread', 'workers': 2 * _cpu_count() + 1},
+    'io': {'worker_class': 'gevent', 'workers': _cpu_count() + 1},
+}
+profile = PROFILES[env('GUNICORN_PROFILE', default='cpu')]
+
+bind = env('GUNICORN_BIND', default='0.0.0.0:8000')
+worker_class = env('GUNICORN_WORKER_CLASS', default=profile['worker_class'])
+workers = env('GUNICORN_WORKERS', default=profile['workers'], cast=int)
+# Потоков в процессе для gthread.
+threads = env('GUNICORN_THREADS', default=4, cast=int)
+# Одновременных запросов в процессе для gevent.
+worker_connections = env('GUNICORN_WORKER_CONNECTIONS', default=100, cast=int)
+
+timeout = env('GUNICORN_TIMEOUT', default=30, cast=int)
+graceful_timeout = env('GUNICORN_GRACEFUL_TIMEOUT', default=30, cast=int)
+# Соединения от nginx держатся открытыми между запросами.
+keepalive = env('GUNICORN_KEEPALIVE', default=5, cast=int)
+
+# Процесс перезапускается после max_requests запросов, чтобы утечки памяти
+# не копились. Разброс не дает всем процессам перезапуститься одновременно.
+max_requests = env('GUNICORN_MAX_REQUESTS', default=1000, cast=int)
+max_requests_jitter = env('GUNICORN_MAX_REQUESTS_JITTER', default=100, cast=int)
+
+# Django загружается один раз в главном процессе до fork: воркеры
+# стартуют быстрее и делят память с главным процессом.
+preload_app = env('GUNICORN_PRELOAD', default=True, cast=bool)
+
+accesslog = env('GUNICORN_ACCESS_LOG', default='-')
+errorlog = '-'
+
+if worker_class == 'gevent':
+    # Модули должны быть пропатчены до загрузки Django (preload_app),
+    # иначе сокеты и потоки, созданные при импорте, будут блокирующими.
+    from gevent import monkey
+    monkey.patch_all()
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+
+def pre_fork(server, worker):
+    """Соединения главного процесса с базой не должны достаться воркерам:
+    один сокет в нескольких процессах ломает протокол postgres."""
+    if server.cfg.preload_app:
+        from django.db import connections
+        connections.close_all()
+
+
+def post_fork(server, worker):
+    """Воркер начинает без унаследованных соединений,
+    первое обращение к базе откроет новое."""
+    if server.cfg.preload_app:
+        from django.db import connections
+        connections.close_all()
+
+
+# Каталог метрик Prometheus, общий для воркеров (см. core/metrics.py).
+_metrics_dir = env('METRICS_DIR', default='')
+
+
+def on_starting(server):
+    """Значения метрик прошлого запуска не должны попасть в /metrics."""
+    if _metrics_dir:
+        os.makedirs(_metrics_dir, exist_ok=True)
+        for name in os.listdir(_metrics_dir):
+            if name.endswith('.db'):
+                os.remove(os.path.join(_metrics_dir, name))
+
+
+def child_exit(server, worker):
+    """Гистограммы и счетчики завершившегося воркера остаются в сумме,
+    prometheus_client удаляет только его значения gauge."""
+    if _metrics_dir:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid, _metrics_dir)
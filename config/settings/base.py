@@ -29,11 +29,14 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.MetricsMiddleware',
+    'core.middleware.QueryCountMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'core.middleware.CartMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -42,7 +45,9 @@ ROOT_URLCONF = 'config.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates, который считает время шаблонов для метрик.
+        'BACKEND': 'core.metrics.TimedDjangoTemplates',
+        'NAME': 'django',
         'DIRS': [os.path.join(BASE_DIR, 'templates')],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -58,6 +63,14 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'config.wsgi.application'
 
+# Общий кэш для всех процессов приложения (категории, меню каталога и т.д.).
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default=''),
+    }
+}
+
 LANGUAGE_CODE = 'ru'
 TIME_ZONE = 'UTC'
 USE_I18N = True
@@ -70,6 +83,12 @@ STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static_files')]
 STATIC_ROOT = os.path.join(BASE_DIR, 'static_root')
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media_root')
 
+# Ширины уменьшенных копий изображений товаров в пикселях (core/images.py).
+IMAGE_VARIANT_WIDTHS = config(
+    'IMAGE_VARIANT_WIDTHS', default='320,640,960',
+    cast=lambda value: tuple(int(width) for width in value.split(','))
+)
+
 AUTHENTICATION_BACKENDS = [
     'django.contrib.auth.backends.ModelBackend',
     'allauth.account.auth_backends.AuthenticationBackend',
@@ -80,3 +99,61 @@ SITE_ID = 1
 LOGIN_REDIRECT_URL = '/'
 
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
+
+# Резервирование товара: количество частей, на которые делится остаток
+# каждого товара, и время жизни резерва в корзине (в секундах).
+STOCK_SHARDS = config('STOCK_SHARDS', default=8, cast=int)
+STOCK_HOLD_TTL = config('STOCK_HOLD_TTL', default=15 * 60, cast=int)
+
+# Сколько секунд анонимный посетитель и прокси могут использовать страницу
+# каталога без повторной проверки (ETag/Last-Modified, см. core/http.py).
+CATALOG_CACHE_MAX_AGE = config('CATALOG_CACHE_MAX_AGE', default=0, cast=int)
+
+# Микрокэш nginx для анонимных посетителей (nginx/nginx.conf): время жизни
+# страницы каталога, адрес nginx для обновления страниц после изменения
+# товаров (пустой - не обновлять), Host этих запросов и их секретный токен.
+CATALOG_PROXY_CACHE_SECONDS = config('CATALOG_PROXY_CACHE_SECONDS', default=10, cast=int)
+PROXY_CACHE_URL = config('PROXY_CACHE_URL', default='')
+PROXY_CACHE_HOST = config('PROXY_CACHE_HOST', default='localhost')
+CACHE_REFRESH_TOKEN = config('CACHE_REFRESH_TOKEN', default='')
+
+# Корзина анонимного посетителя: cookie, срок ее жизни (в секундах)
+# и максимальное количество позиций.
+CART_COOKIE_NAME = 'cart'
+CART_COOKIE_AGE = config('CART_COOKIE_AGE', default=14 * 24 * 60 * 60, cast=int)
+ANONYMOUS_CART_MAX_LINES = config('ANONYMOUS_CART_MAX_LINES', default=50, cast=int)
+
+# Stripe: адрес API (можно указать локальную заглушку, см. команду fake_stripe),
+# время жизни кэша сохраненной карты и ожидание ответа о ней (в секундах).
+STRIPE_API_BASE = config('STRIPE_API_BASE', default='https://api.stripe.com')
+STRIPE_CARD_CACHE_TIMEOUT = config('STRIPE_CARD_CACHE_TIMEOUT', default=5 * 60, cast=int)
+STRIPE_CARD_LOOKUP_TIMEOUT = config('STRIPE_CARD_LOOKUP_TIMEOUT', default=2.0, cast=float)
+# Таймауты соединения и чтения ответа, размер пула соединений
+# и повторы при RateLimitError и APIConnectionError (см. core/stripe_gateway.py).
+STRIPE_CONNECT_TIMEOUT = config('STRIPE_CONNECT_TIMEOUT', default=3.0, cast=float)
+STRIPE_READ_TIMEOUT = config('STRIPE_READ_TIMEOUT', default=30.0, cast=float)
+STRIPE_POOL_SIZE = config('STRIPE_POOL_SIZE', default=10, cast=int)
+STRIPE_MAX_RETRIES = config('STRIPE_MAX_RETRIES', default=2, cast=int)
+STRIPE_RETRY_BASE_DELAY = config('STRIPE_RETRY_BASE_DELAY', default=0.25, cast=float)
+STRIPE_RETRY_MAX_DELAY = config('STRIPE_RETRY_MAX_DELAY', default=2.0, cast=float)
+
+# Сколько секунд промокод хранится в памяти процесса. Изменения промокодов
+# в админке доходят до других процессов с такой задержкой.
+COUPON_LOCAL_CACHE_TIMEOUT = config('COUPON_LOCAL_CACHE_TIMEOUT', default=5, cast=float)
+
+# Асинхронная оплата: PaymentView ставит оплату в очередь, которую
+# выполняет manage.py run_payment_worker с заданным числом потоков.
+PAYMENT_ASYNC = config('PAYMENT_ASYNC', default=False, cast=bool)
+PAYMENT_WORKER_CONCURRENCY = config('PAYMENT_WORKER_CONCURRENCY', default=4, cast=int)
+
+# Заголовок X-DB-Queries с числом запросов к базе в каждом ответе
+# (core.middleware.QueryCountMiddleware). Нужен нагрузочному тесту load_test.
+QUERY_COUNT_HEADER = config('QUERY_COUNT_HEADER', default=False, cast=bool)
+
+# Метрики Prometheus (core/metrics.py): сбор в MetricsMiddleware и эндпоинт
+# /metrics с заголовком Authorization: Bearer METRICS_TOKEN (без токена
+# эндпоинт отключен). В METRICS_DIR процессы gunicorn пишут свои значения,
+# /metrics суммирует их.
+METRICS_ENABLED = config('METRICS_ENABLED', default=False, cast=bool)
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+METRICS_DIR = config('METRICS_DIR', default='')
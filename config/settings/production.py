@@ -11,16 +11,36 @@ AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.NumericPasswordValidator'}
 ]
 
+# Соединения с базой переиспользуются между запросами DB_CONN_MAX_AGE
+# секунд (0 - новое соединение на каждый запрос) и проверяются перед
+# использованием (core/postgresql). С pgbouncer в режиме transaction
+# (DB_HOST=pgbouncer, см. docker-compose.yml) серверные курсоры
+# нужно отключить: DB_DISABLE_SERVER_SIDE_CURSORS=True.
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
+        'ENGINE': 'core.postgresql',
         'NAME': config('DB_NAME'),
         'USER': config('DB_USER'),
         'PASSWORD': config('DB_PASSWORD'),
         'HOST': config('DB_HOST'),
-        'PORT': '5432'
+        'PORT': config('DB_PORT', default='5432'),
+        'CONN_MAX_AGE': config('DB_CONN_MAX_AGE', default=60, cast=int),
+        'CONN_HEALTH_CHECKS': config('DB_CONN_HEALTH_CHECKS', default=True, cast=bool),
+        'DISABLE_SERVER_SIDE_CURSORS': config('DB_DISABLE_SERVER_SIDE_CURSORS', default=False, cast=bool),
     }
 }
 
+# Воркеры gunicorn должны делить один кэш, поэтому по умолчанию
+# используем файловый кэш вместо локального для каждого процесса.
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': config('CACHE_LOCATION', default='/var/tmp/ecommerce_store_cache'),
+    }
+}
+
+# Имена файлов статики с хэшем содержимого и сжатые копии для nginx.
+STATICFILES_STORAGE = 'core.storage.CompressedManifestStaticFilesStorage'
+
 STRIPE_PUBLIC_KEY = config('STRIPE_LIVE_PUBLIC_KEY')
 STRIPE_SECRET_KEY = config('STRIPE_LIVE_SECRET_KEY')
\ No newline at end of file
@@ -3,9 +3,12 @@ from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include
 
+from core.views import prometheus_metrics
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('accounts/', include('allauth.urls')),
+    path('metrics', prometheus_metrics, name='metrics'),
     path('', include('core.urls', namespace='core')),
 ]
 
@@ -0,0 +1,52 @@
+"""
+Адресная книга пользователя.
+
+У пользователя не больше одного адреса по умолчанию каждого типа, это
+гарантирует частичный уникальный индекс (см. Address.Meta). Оба адреса по
+умолчанию выбираются одним запросом и кэшируются по пользователю. Кэш
+сбрасывается сигналами модели Address после фиксации транзакции.
+"""
+from django.core.cache import cache
+from django.db import transaction
+
+
+ADDRESSES_CACHE_TIMEOUT = 60 * 60
+
+
+def _defaults_key(user_id):
+    return f'addresses:defaults:{user_id}'
+
+
+def get_default_addresses(user):
+    """Возвращает адреса пользователя по умолчанию: {тип адреса: Address}."""
+    key = _defaults_key(user.pk)
+    defaults = cache.get(key)
+    if defaults is None:
+        defaults = {
+            address.address_type: address
+            for address in user.address_set.filter(default=True)
+        }
+        cache.set(key, defaults, ADDRESSES_CACHE_TIMEOUT)
+    return defaults
+
+
+def get_default_address(user, address_type):
+    """Адрес по умолчанию указанного типа или None."""
+    return get_default_addresses(user).get(address_type)
+
+
+def save_address(address, default=False):
+    """Сохраняет адрес. С default=True адрес становится адресом по умолчанию
+    своего типа, прежний адрес по умолчанию этого типа теряет отметку."""
+    with transaction.atomic():
+        if default:
+            type(address).objects.filter(
+                user_id=address.user_id, address_type=address.address_type, default=True
+            ).exclude(pk=address.pk).update(default=False)
+            address.default = True
+        address.save()
+    return address
+
+
+def invalidate_default_addresses(user_id):
+    cache.delete(_defaults_key(user_id))
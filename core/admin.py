@@ -1,6 +1,9 @@
 from django.contrib import admin
 
-from .models import Item, OrderItem, Order, Address, Payment, Coupon, Category, Refund, UserProfile
+from .models import (
+    Item, OrderItem, Order, Address, Payment, Coupon, Category, Refund, UserProfile,
+    StockShard, StockHold, PaymentJob
+)
 
 
 def make_refund_accepted(modeladmin, request, queryset):
@@ -10,6 +13,12 @@ def make_refund_accepted(modeladmin, request, queryset):
 make_refund_accepted.short_description = 'Update orders to refund granted'
 
 
+class OrderItemInline(admin.TabularInline):
+    model = OrderItem
+    extra = 0
+    raw_id_fields = ['item', 'user']
+
+
 class OrderAdmin(admin.ModelAdmin):
     """Настройка вывода информации о модели Order
     в административной панели."""
@@ -32,6 +41,13 @@ class OrderAdmin(admin.ModelAdmin):
         'user__username', 'ref_code'
     ]
     actions = [make_refund_accepted]
+    inlines = [OrderItemInline]
+
+
+class PaymentJobAdmin(admin.ModelAdmin):
+    list_display = ['idempotency_key', 'user', 'order', 'amount', 'status', 'updated_at']
+    list_filter = ['status']
+    exclude = ['token']
 
 
 class ItemAdmin(admin.ModelAdmin):
@@ -47,3 +63,6 @@ admin.site.register(Coupon)
 admin.site.register(Category)
 admin.site.register(Refund)
 admin.site.register(UserProfile)
+admin.site.register(StockShard)
+admin.site.register(StockHold)
+admin.site.register(PaymentJob, PaymentJobAdmin)
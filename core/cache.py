@@ -0,0 +1,80 @@
+"""
+Версионированный кэш.
+
+Для каждого пространства имен (например, 'categories') в общем кэше хранится
+номер версии, который входит в ключи всех записей этого пространства.
+Чтобы сбросить все записи разом, достаточно увеличить версию: старые ключи
+перестают запрашиваться и вытесняются бэкендом по таймауту.
+
+LocalCache - небольшой кэш в памяти процесса с коротким временем жизни
+для самых частых запросов, перед общим кэшем.
+"""
+import threading
+import time
+
+from django.core.cache import cache
+
+
+def _version_key(namespace):
+    return f'version:{namespace}'
+
+
+def _initial_version():
+    # Метка времени в мс: если ключ версии был вытеснен из кэша,
+    # новая версия не совпадет ни с одной из прежних.
+    return int(time.time() * 1000)
+
+
+def get_version(namespace):
+    """Текущая версия пространства имен."""
+    key = _version_key(namespace)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _initial_version(), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(namespace):
+    """Увеличивает версию, делая недействительными все записи пространства."""
+    key = _version_key(namespace)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # Ключа версии еще нет в кэше.
+        version = _initial_version()
+        cache.set(key, version, None)
+        return version
+
+
+def versioned_key(namespace, *parts):
+    """Ключ записи с учетом текущей версии пространства имен."""
+    return ':'.join([namespace, str(get_version(namespace)), *map(str, parts)])
+
+
+class LocalCache:
+    """Кэш в памяти процесса. Записи живут timeout секунд, при
+    переполнении кэш очищается целиком. Другие процессы об изменениях
+    не узнают, поэтому timeout должен быть коротким."""
+
+    def __init__(self, timeout, max_size=1000):
+        self.timeout = timeout
+        self.max_size = max_size
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return default
+        return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            if len(self._data) >= self.max_size:
+                self._data.clear()
+            self._data[key] = (time.monotonic() + self.timeout, value)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
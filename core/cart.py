@@ -0,0 +1,445 @@
+"""
+Корзина пользователя.
+
+Каждое изменение корзины выполняется в одной транзакции. Первой командой
+транзакции всегда идет запись (UPDATE/DELETE), поэтому и PostgreSQL
+(блокировка строк), и SQLite (блокировка базы на запись) сериализуют
+параллельные изменения одной позиции, а количество меняется выражением F()
+без чтения в Python, так что нажатия не теряются.
+
+Корзина анонимного посетителя хранится в подписанной cookie и не пишет
+в базу. При входе она одним набором запросов переносится в корзину
+пользователя (сигнал user_logged_in из allauth). Представления работают
+с request.cart (см. CartMiddleware), у обеих корзин одинаковый интерфейс.
+"""
+import json
+from decimal import Decimal
+
+from allauth.account.signals import user_logged_in
+from django.conf import settings
+from django.contrib import messages
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, IntegerField, Subquery, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from core import inventory
+from core.models import PRICE_FIELD, Item, Order, OrderItem, Payment, UserProfile
+from core.query_budget import query_budget
+from core.services import create_reference_code
+
+
+ITEM_ADDED = 'Товар был добавлен в вашу корзину.'
+QUANTITY_CHANGED = 'Количество товара в корзине было изменено.'
+ITEM_REMOVED = 'Товар был удален из вашей корзины.'
+ITEM_NOT_IN_CART = 'Этого товара нет в вашей корзине.'
+NO_ACTIVE_CART = 'У вас нет активной корзины. Для начала добавьте товар.'
+OUT_OF_STOCK = 'К сожалению, этого товара больше нет в наличии.'
+CART_FULL = 'В корзине слишком много товаров. Войдите, чтобы добавить еще.'
+MERGE_OUT_OF_STOCK = 'Часть товаров из вашей корзины закончилась, они не были добавлены.'
+CART_CHANGED = 'Корзина изменилась во время оплаты. Оплата не списана, попробуйте еще раз.'
+CART_CHANGED_REFUNDED = ('Корзина изменилась во время оплаты. '
+                         'Списанная сумма возвращена, попробуйте еще раз.')
+REFUND_FAILED = ('Корзина изменилась во время оплаты, а вернуть списанную сумму '
+                 'не удалось. Мы свяжемся с вами.')
+
+CART_COOKIE_SALT = 'core.cart'
+
+
+class CartChanged(Exception):
+    """Итог или позиции заказа не совпадают с оплаченными."""
+
+
+class CartSummary:
+    """Итоги корзины: позиции с ценами, скидка, промокод и итоговая стоимость.
+    Позиции загружаются одним запросом, итоги берутся из полей заказа."""
+
+    def __init__(self, order):
+        self.order = order
+        self.lines = list(order.items.with_prices().select_related('item').order_by('id'))
+        self.count = len(self.lines)
+        self.subtotal = order.subtotal
+        self.saved = order.discount
+        self.coupon = order.coupon
+        self.total = order.total
+        # Сумма промокода на момент его применения.
+        self.coupon_amount = self.subtotal - self.saved - self.total
+
+    def _summarize(self, lines, coupon):
+        self.lines = lines
+        self.count = len(self.lines)
+        self.subtotal = sum(
+            (line.quantity * line.item.price for line in self.lines), Decimal(0))
+        self.saved = sum((line.line_saved for line in self.lines), Decimal(0))
+        self.coupon = coupon
+        self.coupon_amount = self.coupon.amount if self.coupon else Decimal(0)
+        self.total = self.subtotal - self.saved - self.coupon_amount
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __len__(self):
+        return self.count
+
+
+class CartLine:
+    """Позиция анонимной корзины с теми же полями цены, что у OrderItem
+    и OrderItemQuerySet.with_prices(), цены берутся из товара."""
+
+    def __init__(self, item, quantity):
+        self.item = item
+        self.quantity = quantity
+        self.price = item.price
+        self.discount_price = item.discount_price
+        self.unit_price = item.discount_price if item.discount_price else item.price
+        self.unit_saved = item.price - self.unit_price
+        self.line_total = quantity * self.unit_price
+        self.line_saved = quantity * self.unit_saved
+
+
+class AnonymousCartSummary(CartSummary):
+    """Итоги анонимной корзины по текущим ценам,
+    товары загружаются одним запросом."""
+
+    def __init__(self, lines):
+        self.order = None
+        items = Item.objects.in_bulk(list(lines))
+        self._summarize([
+            CartLine(items[item_id], quantity)
+            for item_id, quantity in sorted(lines.items()) if item_id in items
+        ], None)
+
+
+def _cart_lines(user, item):
+    """Позиция товара в активной корзине пользователя, выбирается
+    по индексу core_orderitem_one_active_per_item без соединения с заказом."""
+    return OrderItem.objects.filter(user=user, ordered=False, item=item)
+
+
+def _get_active_order(user, create=False):
+    """Возвращает активный заказ пользователя, заблокированный
+    до конца транзакции. При необходимости создает его."""
+    order = Order.objects.select_for_update().filter(user=user, ordered=False).first()
+    if order is None and create:
+        # Профиль служит блокировкой, чтобы параллельные запросы
+        # не создали пользователю два активных заказа.
+        UserProfile.objects.select_for_update().filter(user=user).first()
+        order = Order.objects.select_for_update().filter(user=user, ordered=False).first()
+        if order is None:
+            try:
+                with transaction.atomic():
+                    order = Order.objects.create(user=user, ordered_date=timezone.now())
+            except IntegrityError:
+                # Без профиля блокировки нет, и корзину успел создать
+                # параллельный запрос: вторую не дал создать
+                # индекс core_order_one_active_per_user.
+                order = Order.objects.select_for_update().get(user=user, ordered=False)
+    return order
+
+
+def _unit_amounts(price, discount_price):
+    """Цена единицы товара без скидки и скидка на единицу."""
+    return price, (price - discount_price if discount_price else Decimal(0))
+
+
+def _shift_totals(user, regular, saved):
+    """Меняет итоги активного заказа: regular - изменение суммы по полным
+    ценам, saved - изменение скидки на товары. Суммы - числа или выражения.
+    Итоги меняются одним UPDATE без пересчета всей корзины."""
+    Order.objects.filter(user=user, ordered=False).update(
+        subtotal=F('subtotal') + regular,
+        discount=F('discount') + saved,
+        total=F('total') + regular - saved,
+    )
+
+
+def _shift_line_totals(user, item, quantity):
+    """Меняет итоги на quantity единиц позиции по ее зафиксированным ценам.
+    Вызывается после изменения позиции: строка уже заблокирована."""
+    price, saved = _unit_amounts(
+        *_cart_lines(user, item).values_list('price', 'discount_price').get())
+    _shift_totals(user, quantity * price, quantity * saved)
+
+
+def _delete_line(user, item):
+    """Удаляет позицию товара из активной корзины, возвращает True,
+    если позиция была в корзине."""
+    # Итоги уменьшаются подзапросом к позиции до ее удаления: первой командой
+    # транзакции остается запись, а позиция, которой нет, дает ноль.
+    amounts = _cart_lines(user, item).with_prices().values('line_total', 'line_saved')
+    line_saved = Coalesce(
+        Subquery(amounts.values('line_saved')[:1]), Value(0), output_field=PRICE_FIELD)
+    line_total = Coalesce(
+        Subquery(amounts.values('line_total')[:1]), Value(0), output_field=PRICE_FIELD)
+    Order.objects.filter(user=user, ordered=False).update(
+        subtotal=F('subtotal') - line_total - line_saved,
+        discount=F('discount') - line_saved,
+        total=F('total') - line_total,
+    )
+    deleted, _ = _cart_lines(user, item).delete()
+    return bool(deleted)
+
+
+def _add_line(user, item):
+    if _cart_lines(user, item).update(quantity=F('quantity') + 1):
+        _shift_line_totals(user, item, 1)
+        return QUANTITY_CHANGED
+
+    order = _get_active_order(user, create=True)
+    # Позицию могли добавить, пока мы ждали блокировку заказа.
+    if _cart_lines(user, item).update(quantity=F('quantity') + 1):
+        _shift_line_totals(user, item, 1)
+        return QUANTITY_CHANGED
+    try:
+        with transaction.atomic():
+            OrderItem.objects.create(
+                order=order, user=user, item=item,
+                price=item.price, discount_price=item.discount_price
+            )
+    except IntegrityError:
+        # Позицию успел создать параллельный запрос: вторую не дал
+        # создать индекс core_orderitem_one_active_per_item.
+        _cart_lines(user, item).update(quantity=F('quantity') + 1)
+        _shift_line_totals(user, item, 1)
+        return QUANTITY_CHANGED
+    _shift_totals(user, *_unit_amounts(item.price, item.discount_price))
+    return ITEM_ADDED
+
+
+@query_budget(queries=7, duplicates=1)
+def add_item_to_cart(user, item):
+    """Добавляет товар в корзину и резервирует его на складе."""
+    try:
+        with transaction.atomic():
+            message = _add_line(user, item)
+            if not inventory.reserve(user, item.pk):
+                # Откатываем изменение корзины.
+                raise inventory.OutOfStock
+            return message
+    except inventory.OutOfStock:
+        return OUT_OF_STOCK
+
+
+def remove_item_from_cart(user, item):
+    """Удаляет позицию товара из корзины и снимает резерв."""
+    with transaction.atomic():
+        if _delete_line(user, item):
+            inventory.release(user, item.pk)
+            return ITEM_REMOVED
+        if _get_active_order(user) is None:
+            return NO_ACTIVE_CART
+        return ITEM_NOT_IN_CART
+
+
+def remove_single_item_from_cart(user, item):
+    """Удаляет из корзины один экземпляр товара. Если экземпляр
+    последний, то удаляет позицию целиком."""
+    with transaction.atomic():
+        decremented = _cart_lines(user, item).filter(
+            quantity__gt=1).update(quantity=F('quantity') - 1)
+        if decremented:
+            _shift_line_totals(user, item, -1)
+        if decremented or _delete_line(user, item):
+            inventory.release(user, item.pk, 1)
+            return QUANTITY_CHANGED
+        if _get_active_order(user) is None:
+            return NO_ACTIVE_CART
+        return ITEM_NOT_IN_CART
+
+
+def apply_coupon(order, coupon):
+    """Применяет промокод к активному заказу. Итог считается
+    по сохраненным суммам заказа, позиции не читаются."""
+    Order.objects.filter(pk=order.pk).update(
+        coupon=coupon, total=F('subtotal') - F('discount') - coupon.amount)
+
+
+def check_order(order, amount, lines, lock=False):
+    """Вызывает CartChanged, если итог активного заказа не равен amount
+    или его позиции не равны lines ({id товара: количество}).
+    С lock=True заказ блокируется до конца транзакции."""
+    orders = Order.objects.filter(pk=order.pk, ordered=False)
+    if lock:
+        orders = orders.select_for_update()
+    total = orders.values_list('total', flat=True).first()
+    current = dict(OrderItem.objects.filter(order_id=order.pk).values_list('item_id', 'quantity'))
+    if total != amount or current != lines:
+        raise CartChanged
+
+
+def finalize_order(order, user, charge_id, amount, stock):
+    """Подтверждает оплаченный заказ в одной транзакции: создает платеж,
+    подтверждает позиции, присваивает заказу уникальный код и списывает
+    товар со склада. Цены позиций и итоги заказа не меняются: по ним
+    и была списана оплата. Если корзина изменилась, пока шло списание,
+    вызывает CartChanged и заказ не меняет. Количество запросов
+    не зависит от размера корзины. stock: {id товара: количество}."""
+    with transaction.atomic():
+        payment = Payment.objects.create(
+            stripe_charge_id=charge_id,
+            user=user,
+            amount=amount
+        )
+        check_order(order, amount, stock, lock=True)
+        order.items.update(ordered=True)
+        order.ordered = True
+        order.ordered_date = timezone.now()
+        order.payment = payment
+        order.reference_code = create_reference_code()
+        Order.objects.filter(pk=order.pk).update(
+            ordered=True,
+            ordered_date=order.ordered_date,
+            payment=payment,
+            reference_code=order.reference_code,
+        )
+        inventory.commit(user, stock)
+    return payment
+
+
+def merge_lines(user, lines):
+    """Переносит позиции {id товара: количество} в активную корзину
+    пользователя и резервирует товар. Кроме резервирования, число запросов
+    не зависит от числа позиций. Возвращает id товаров, которых не хватило."""
+    with transaction.atomic():
+        reserved = {
+            item_id: quantity for item_id, quantity in lines.items()
+            if inventory.reserve(user, item_id, quantity)
+        }
+        if reserved:
+            cart_lines = OrderItem.objects.filter(
+                user=user, ordered=False, item_id__in=reserved)
+            added = Case(
+                *[When(item_id=item_id, then=Value(quantity))
+                  for item_id, quantity in reserved.items()],
+                output_field=IntegerField(),
+            )
+            cart_lines.update(quantity=F('quantity') + added)
+            existing = set(cart_lines.values_list('item_id', flat=True))
+            new = [item_id for item_id in reserved if item_id not in existing]
+            if new:
+                order = _get_active_order(user, create=True)
+                OrderItem.objects.bulk_create([
+                    OrderItem(order=order, user=user, item_id=item_id, quantity=reserved[item_id],
+                              price=price, discount_price=discount_price)
+                    for item_id, price, discount_price in Item.objects.filter(
+                        pk__in=new).values_list('id', 'price', 'discount_price')
+                ])
+            regular = saved = Decimal(0)
+            for item_id, price, discount_price in cart_lines.values_list(
+                    'item_id', 'price', 'discount_price'):
+                unit_regular, unit_saved = _unit_amounts(price, discount_price)
+                regular += reserved[item_id] * unit_regular
+                saved += reserved[item_id] * unit_saved
+            _shift_totals(user, regular, saved)
+    return set(lines) - set(reserved)
+
+
+class UserCart:
+    """Корзина пользователя в базе. Количество позиций считается
+    один раз за запрос, изменения корзины его сбрасывают."""
+
+    def __init__(self, user):
+        self.user = user
+        self._count = None
+
+    def add_item_to_cart(self, item):
+        self._count = None
+        return add_item_to_cart(self.user, item)
+
+    def remove_item_from_cart(self, item):
+        self._count = None
+        return remove_item_from_cart(self.user, item)
+
+    def remove_single_item_from_cart(self, item):
+        self._count = None
+        return remove_single_item_from_cart(self.user, item)
+
+    def count(self):
+        if self._count is None:
+            self._count = OrderItem.objects.filter(user=self.user, ordered=False).count()
+        return self._count
+
+
+class AnonymousCart:
+    """Корзина анонимного посетителя в подписанной cookie: {id товара:
+    количество}. Товар не резервируется, наличие проверяется по Item.quantity."""
+
+    def __init__(self, lines=None):
+        self.lines = lines or {}
+        self.modified = False
+
+    @classmethod
+    def from_request(cls, request):
+        value = request.get_signed_cookie(
+            settings.CART_COOKIE_NAME, default=None,
+            salt=CART_COOKIE_SALT, max_age=settings.CART_COOKIE_AGE)
+        try:
+            lines = {int(item_id): int(quantity)
+                     for item_id, quantity in json.loads(value).items()}
+        except (TypeError, ValueError, AttributeError):
+            lines = {}
+        return cls({item_id: quantity for item_id, quantity in lines.items() if quantity > 0})
+
+    def add_item_to_cart(self, item):
+        quantity = self.lines.get(item.pk, 0) + 1
+        if quantity > item.quantity:
+            return OUT_OF_STOCK
+        if quantity == 1 and len(self.lines) >= settings.ANONYMOUS_CART_MAX_LINES:
+            return CART_FULL
+        self.lines[item.pk] = quantity
+        self.modified = True
+        return ITEM_ADDED if quantity == 1 else QUANTITY_CHANGED
+
+    def remove_item_from_cart(self, item):
+        if item.pk in self.lines:
+            del self.lines[item.pk]
+            self.modified = True
+            return ITEM_REMOVED
+        return ITEM_NOT_IN_CART if self.lines else NO_ACTIVE_CART
+
+    def remove_single_item_from_cart(self, item):
+        quantity = self.lines.get(item.pk)
+        if quantity is None:
+            return ITEM_NOT_IN_CART if self.lines else NO_ACTIVE_CART
+        if quantity > 1:
+            self.lines[item.pk] = quantity - 1
+        else:
+            del self.lines[item.pk]
+        self.modified = True
+        return QUANTITY_CHANGED
+
+    def count(self):
+        return len(self.lines)
+
+    def summary(self):
+        return AnonymousCartSummary(self.lines)
+
+    def clear(self):
+        self.modified = bool(self.lines) or self.modified
+        self.lines = {}
+
+    def save(self, response):
+        """Записывает измененную корзину в cookie ответа."""
+        if not self.modified:
+            return
+        if not self.lines:
+            response.delete_cookie(settings.CART_COOKIE_NAME)
+            return
+        response.set_signed_cookie(
+            settings.CART_COOKIE_NAME, json.dumps(self.lines, separators=(',', ':')),
+            salt=CART_COOKIE_SALT, max_age=settings.CART_COOKIE_AGE,
+            httponly=True, samesite='Lax',
+        )
+
+
+def anonymous_cart_login_receiver(sender, request, user, **kwargs):
+    """Переносит анонимную корзину в корзину пользователя при входе."""
+    anonymous_cart = getattr(request, 'anonymous_cart', None)
+    if not anonymous_cart or not anonymous_cart.lines:
+        return
+    if merge_lines(user, anonymous_cart.lines):
+        messages.warning(request, MERGE_OUT_OF_STOCK)
+    anonymous_cart.clear()
+
+
+user_logged_in.connect(anonymous_cart_login_receiver)
@@ -0,0 +1,116 @@
+"""
+Локальная заглушка Stripe API для разработки и нагрузочных тестов.
+
+Поддерживает запросы, которые делает магазин: создание и получение
+покупателя, список его карт, создание платежа и возврата (с учетом
+Idempotency-Key). Токен `tok_chargeDeclined` имитирует отклоненную
+карту. Чтобы магазин обращался к заглушке, укажите
+STRIPE_API_BASE=http://127.0.0.1:12111.
+"""
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+
+DECLINED_TOKEN = 'tok_chargeDeclined'
+
+
+def _fake_id(prefix):
+    return f'{prefix}_fake_{uuid.uuid4().hex[:14]}'
+
+
+def _card():
+    return {
+        'id': 'card_fake_4242', 'object': 'card', 'brand': 'Visa',
+        'last4': '4242', 'exp_month': 12, 'exp_year': 2030,
+    }
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Задержка ответа в секундах, имитирует медленный платежный шлюз.
+    latency = 0.0
+    idempotent_responses = {}
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _read_form(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return dict(parse_qsl(self.rfile.read(length).decode()))
+
+    def _customer(self, customer_id, email=None):
+        return {
+            'id': customer_id, 'object': 'customer', 'email': email,
+            'sources': {'object': 'list', 'data': [_card()]},
+        }
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        parts = urlparse(self.path).path.strip('/').split('/')
+        if parts[:2] == ['v1', 'customers'] and len(parts) == 4 and parts[3] == 'sources':
+            return self._send(200, {'object': 'list', 'data': [_card()], 'has_more': False})
+        if parts[:2] == ['v1', 'customers'] and len(parts) == 3:
+            return self._send(200, self._customer(parts[2]))
+        self._send(404, {'error': {'type': 'invalid_request_error', 'message': 'Not found'}})
+
+    def do_POST(self):
+        time.sleep(self.latency)
+        form = self._read_form()
+        key = self.headers.get('Idempotency-Key')
+        if key:
+            with self.lock:
+                cached = self.idempotent_responses.get(key)
+            if cached:
+                return self._send(*cached)
+
+        path = urlparse(self.path).path.rstrip('/')
+        if path == '/v1/customers':
+            response = 200, self._customer(_fake_id('cus'), form.get('email'))
+        elif path == '/v1/charges':
+            if form.get('source') == DECLINED_TOKEN:
+                response = 402, {'error': {
+                    'type': 'card_error', 'code': 'card_declined',
+                    'message': 'Your card was declined.',
+                }}
+            else:
+                response = 200, {
+                    'id': _fake_id('ch'), 'object': 'charge',
+                    'amount': int(form.get('amount', 0)), 'currency': form.get('currency'),
+                    'customer': form.get('customer'), 'paid': True, 'status': 'succeeded',
+                }
+        elif path == '/v1/refunds':
+            response = 200, {
+                'id': _fake_id('re'), 'object': 'refund',
+                'charge': form.get('charge'), 'status': 'succeeded',
+            }
+        else:
+            response = 404, {'error': {'type': 'invalid_request_error', 'message': 'Not found'}}
+
+        if key:
+            with self.lock:
+                self.idempotent_responses[key] = response
+        self._send(*response)
+
+
+def serve(host='127.0.0.1', port=12111, latency=0.0):
+    """Запускает заглушку и блокирует поток до остановки."""
+    handler = type('Handler', (FakeStripeHandler,), {'latency': latency})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -2,6 +2,7 @@ from django import forms
 from django_countries.fields import CountryField
 from django_countries.widgets import CountrySelectWidget
 
+from core import addresses
 from .models import Address
 
 
@@ -48,15 +49,16 @@ class CheckoutForm(forms.Form):
     payment_option = forms.ChoiceField(
         widget=forms.RadioSelect, choices=PAYMENT_CHOICES)
 
+    def _save_addresses(self, order):
+        """Сохраняет адреса заказа. Адрес доставки выбирается на том же
+        шаге и сохраняется вместе с платежным. Остальные поля заказа
+        (итоги, оплату) меняют корзина и оплата, их не перезаписываем."""
+        order.save(update_fields=['shipping_address', 'billing_address'])
+
     def set_default_shipping_address(self, user, order):
         """Используем адрес доставки по умолчанию."""
-        address_qs = Address.objects.filter(
-            user=user,
-            address_type='S',
-            default=True
-        )
-        if address_qs.exists():
-            shipping_address = address_qs[0]
+        shipping_address = addresses.get_default_address(user, 'S')
+        if shipping_address is not None:
             order.shipping_address = shipping_address
             return shipping_address
         raise forms.ValidationError('Адрес доставки по умолчанию не задан.')
@@ -81,42 +83,36 @@ class CheckoutForm(forms.Form):
                 zip=shipping_zip,
                 address_type='S'
             )
-            shipping_address.save()
+            # Отмечаем как адрес по умолчанию.
+            addresses.save_address(
+                shipping_address, default=self.cleaned_data['set_default_shipping'])
 
             order.shipping_address = shipping_address
-            order.save()
-
-            # Отмечаем как адрес по умолчанию.
-            if self.cleaned_data['set_default_shipping']:
-                shipping_address.default = True
-                shipping_address.save()
-                return shipping_address
+            return shipping_address
 
         raise forms.ValidationError(
             'Пожалуйста, заполните обязательные поля адреса доставки.')
 
     def set_same_billing_address(self, address, order):
         """Если адрес счета тот же, что у адреса доставки."""
-        billing_address = address
-        billing_address.pk = None
-        billing_address.save()
-        billing_address.address_type = 'B'
-        billing_address.save()
+        billing_address = Address.objects.create(
+            user_id=address.user_id,
+            street_address=address.street_address,
+            apartment_address=address.apartment_address,
+            country=address.country,
+            zip=address.zip,
+            address_type='B'
+        )
         order.billing_address = billing_address
-        order.save()
+        self._save_addresses(order)
         return order
 
     def set_default_billing_address(self, user, order):
         """Используем платежный адрес по умолчанию."""
-        address_qs = Address.objects.filter(
-            user=user,
-            address_type='B',
-            default=True
-        )
-        if address_qs.exists():
-            billing_address = address_qs[0]
+        billing_address = addresses.get_default_address(user, 'B')
+        if billing_address is not None:
             order.billing_address = billing_address
-            order.save()
+            self._save_addresses(order)
             return billing_address
         raise forms.ValidationError('Сохраненный платежный адрес не найден.')
 
@@ -139,15 +135,11 @@ class CheckoutForm(forms.Form):
                 zip=billing_zip,
                 address_type='B'
             )
-            billing_address.save()
+            addresses.save_address(
+                billing_address, default=self.cleaned_data['set_default_billing'])
 
             order.billing_address = billing_address
-            order.save()
-
-            if self.cleaned_data['set_defaul_billing']:
-                billing_address.default = True
-                billing_address.save()
-
+            self._save_addresses(order)
             return billing_address
         raise forms.ValidationError('Пожалуйста, заполните обязательные поля платежного адреса.')
 
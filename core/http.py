@@ -0,0 +1,67 @@
+"""
+Условные GET-запросы для страниц каталога.
+
+Страница каталога зависит от данных каталога и от состояния посетителя:
+шапки с корзиной и кнопками входа и непоказанных сообщений. ETag собирается
+из версии каталога (или времени изменения товара) и состояния посетителя,
+поэтому повторный запрос с If-None-Match получает 304 без загрузки товаров
+и рендеринга шаблона. Пока у посетителя есть непоказанные сообщения,
+валидаторы не выдаются и страница всегда рендерится.
+"""
+import hashlib
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.http import condition
+
+from core.cache import get_version
+
+
+def visitor_state(request):
+    """Часть валидатора, которая зависит от посетителя."""
+    user = request.user.pk if request.user.is_authenticated else 'anonymous'
+    return f'{user}:{request.cart.count()}'
+
+
+class ConditionalGetMixin:
+    """Отвечает 304 Not Modified, если страница не изменилась, и выставляет
+    Cache-Control и Vary. Страница зависит от версий пространств имен кэша
+    из validator_versions, наследник может дополнить их в get_validator_parts()
+    и вернуть время изменения страницы из get_last_modified()."""
+    validator_versions = ()
+
+    def get_validator_parts(self):
+        return [get_version(namespace) for namespace in self.validator_versions]
+
+    def get_last_modified(self):
+        return None
+
+    def _has_messages(self):
+        return bool(len(get_messages(self.request)))
+
+    def _etag(self, request, *args, **kwargs):
+        if self._has_messages():
+            return None
+        parts = self.get_validator_parts()
+        if parts is None:
+            return None
+        key = ':'.join(map(str, [*parts, visitor_state(request)]))
+        return hashlib.md5(key.encode()).hexdigest()
+
+    def _last_modified(self, request, *args, **kwargs):
+        if self._has_messages():
+            return None
+        return self.get_last_modified()
+
+    def get(self, request, *args, **kwargs):
+        view = condition(etag_func=self._etag, last_modified_func=self._last_modified)(super().get)
+        response = view(request, *args, **kwargs)
+        patch_vary_headers(response, ('Cookie',))
+        if request.user.is_authenticated or self._has_messages():
+            patch_cache_control(response, private=True, max_age=0, must_revalidate=True)
+        else:
+            patch_cache_control(response, public=True, max_age=settings.CATALOG_CACHE_MAX_AGE)
+            # Время жизни в микрокэше nginx, браузеру заголовок не передается.
+            response['X-Accel-Expires'] = settings.CATALOG_PROXY_CACHE_SECONDS
+        return response
@@ -0,0 +1,139 @@
+"""
+Уменьшенные копии изображений товаров.
+
+Для каждого изображения создаются копии шириной IMAGE_VARIANT_WIDTHS
+в форматах WebP и JPEG: MEDIA_ROOT/variants/<хэш>/<ширина>.<формат>.
+Хэш считается по содержимому исходного файла и параметрам копий, поэтому
+файлы копий никогда не меняются и их можно кэшировать навсегда. Хэш
+хранится в Item.image_hash, тег responsive_image строит по нему srcset.
+
+Копии создаются после сохранения товара, для старых товаров - командой
+build_image_variants или в фоне при первом показе товара без копий.
+"""
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from core.cache import bump_version
+
+
+logger = logging.getLogger(__name__)
+
+VARIANTS_DIR = 'variants'
+
+# Расширение файла, формат Pillow и параметры сохранения.
+FORMATS = (
+    ('webp', 'WEBP', {'quality': 80, 'method': 4}),
+    ('jpg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+)
+
+# Фоновое создание копий для товаров, показанных без них.
+variants_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='image-variants')
+_scheduled = set()
+_scheduled_lock = threading.Lock()
+
+
+def content_hash(source_path, widths):
+    """Хэш содержимого изображения и параметров копий."""
+    digest = hashlib.sha1(repr((tuple(widths), FORMATS)).encode())
+    with open(source_path, 'rb') as source:
+        for chunk in iter(lambda: source.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def variant_name(image_hash, width, extension):
+    return f'{VARIANTS_DIR}/{image_hash}/{width}.{extension}'
+
+
+def _flatten(image):
+    """Переводит изображение в RGB, прозрачные области становятся белыми."""
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def build_variants(source_path, media_root, widths):
+    """Создает копии изображения и возвращает его хэш. Не обращается к базе,
+    поэтому подходит для пула процессов. Уже созданные копии не пересоздаются."""
+    image_hash = content_hash(source_path, widths)
+    paths = {
+        (width, extension): os.path.join(media_root, variant_name(image_hash, width, extension))
+        for width in widths for extension, _, _ in FORMATS
+    }
+    if all(os.path.exists(path) for path in paths.values()):
+        return image_hash
+
+    os.makedirs(os.path.dirname(next(iter(paths.values()))), exist_ok=True)
+    with Image.open(source_path) as source:
+        image = _flatten(ImageOps.exif_transpose(source))
+    for width in widths:
+        # Изображение не увеличивается: узкий оригинал сохраняется как есть.
+        variant = image.copy()
+        variant.thumbnail((width, image.height), Image.LANCZOS)
+        for extension, image_format, options in FORMATS:
+            path = paths[width, extension]
+            # Пишем во временный файл, чтобы nginx не отдал недописанную копию.
+            variant.save(path + '.tmp', image_format, **options)
+            os.replace(path + '.tmp', path)
+    return image_hash
+
+
+def update_item_variants(item):
+    """Создает копии изображения товара и сохраняет хэш.
+    Возвращает хэш или None, если файла нет или это не изображение."""
+    if not item.image:
+        return None
+    try:
+        image_hash = build_variants(
+            item.image.path, settings.MEDIA_ROOT, settings.IMAGE_VARIANT_WIDTHS)
+    except (OSError, ValueError) as e:
+        logger.warning('Image variants for item %s failed: %s', item.pk, e)
+        return None
+    if image_hash != item.image_hash:
+        # update() не вызывает сигналы, поэтому версию каталога меняем сами.
+        type(item).objects.filter(pk=item.pk).update(
+            image_hash=image_hash, updated_at=timezone.now())
+        item.image_hash = image_hash
+        bump_version('catalog')
+    return image_hash
+
+
+def _update_scheduled(item):
+    image_hash = None
+    try:
+        image_hash = update_item_variants(item)
+    finally:
+        connection.close()
+    if image_hash:
+        with _scheduled_lock:
+            _scheduled.discard(item.pk)
+    # Иначе товар остается в _scheduled: повторять ошибку при каждом
+    # показе бессмысленно, ее исправит сохранение товара или команда.
+
+
+def schedule_variants(item):
+    """Создает копии в фоне, не задерживая ответ."""
+    with _scheduled_lock:
+        if item.pk in _scheduled:
+            return
+        _scheduled.add(item.pk)
+    variants_executor.submit(_update_scheduled, item)
+
+
+def srcset(image_hash, extension):
+    return ', '.join(
+        f'{default_storage.url(variant_name(image_hash, width, extension))} {width}w'
+        for width in settings.IMAGE_VARIANT_WIDTHS
+    )
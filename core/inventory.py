@@ -0,0 +1,165 @@
+"""
+Резервирование товара на складе.
+
+Свободный остаток товара хранится в нескольких строках StockShard. Резерв
+списывает единицы из случайной части условным UPDATE
+(`available = available - n WHERE available >= n`), поэтому покупатели
+одного товара блокируют разные строки и не перепродают остаток.
+Под каждую списанную порцию создается StockHold с ограниченным сроком жизни:
+при оплате резервы удаляются и списываются с Item.quantity, а просроченные
+резервы возвращает в остаток команда release_expired_holds.
+"""
+import random
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Sum, Value, When
+from django.utils import timezone
+
+from core.models import Item, StockHold, StockShard
+
+
+class OutOfStock(Exception):
+    """Недостаточно товара на складе."""
+
+
+def _expires_at():
+    return timezone.now() + timedelta(seconds=settings.STOCK_HOLD_TTL)
+
+
+def _take(item_id, number, quantity):
+    return StockShard.objects.filter(
+        item_id=item_id, number=number, available__gte=quantity
+    ).update(available=F('available') - quantity)
+
+
+def _give_back(item_id, returned):
+    """Возвращает единицы в части остатка: {номер части: количество}."""
+    for number, quantity in returned.items():
+        StockShard.objects.filter(item_id=item_id, number=number).update(
+            available=F('available') + quantity)
+
+
+def _take_from_shards(item_id, quantity):
+    """Списывает товар из частей остатка, возвращает список (часть, количество)."""
+    # Обычно хватает одной случайной части.
+    number = random.randrange(settings.STOCK_SHARDS)
+    if _take(item_id, number, quantity):
+        return [(number, quantity)]
+
+    taken = []
+    remaining = quantity
+    shards = list(StockShard.objects.filter(
+        item_id=item_id, available__gt=0).values_list('number', 'available'))
+    random.shuffle(shards)
+    for number, available in shards:
+        portion = min(available, remaining)
+        if _take(item_id, number, portion):
+            taken.append((number, portion))
+            remaining -= portion
+            if not remaining:
+                return taken
+    raise OutOfStock
+
+
+def reserve(user, item_id, quantity=1):
+    """Резервирует товар для пользователя.
+    Возвращает False, если свободного товара не хватает."""
+    try:
+        with transaction.atomic():
+            taken = _take_from_shards(item_id, quantity)
+            expires_at = _expires_at()
+            StockHold.objects.bulk_create([
+                StockHold(user=user, item_id=item_id, shard=number,
+                          quantity=portion, expires_at=expires_at)
+                for number, portion in taken
+            ])
+    except OutOfStock:
+        return False
+    return True
+
+
+def release(user, item_id, quantity=None):
+    """Возвращает в остаток резерв пользователя на товар,
+    начиная с последних. Без quantity снимает весь резерв."""
+    with transaction.atomic():
+        holds = StockHold.objects.select_for_update().filter(
+            user=user, item_id=item_id).order_by('-expires_at', '-id')
+        returned = defaultdict(int)
+        deleted = []
+        remaining = quantity
+        for hold in holds:
+            if remaining is not None and remaining <= 0:
+                break
+            portion = hold.quantity if remaining is None else min(hold.quantity, remaining)
+            returned[hold.shard] += portion
+            if portion == hold.quantity:
+                deleted.append(hold.pk)
+            else:
+                StockHold.objects.filter(pk=hold.pk).update(quantity=F('quantity') - portion)
+            if remaining is not None:
+                remaining -= portion
+        StockHold.objects.filter(pk__in=deleted).delete()
+        _give_back(item_id, returned)
+
+
+def secure(user, lines):
+    """Перед оплатой проверяет, что каждая позиция заказа покрыта резервом,
+    дорезервирует недостающее и продлевает резервы на время оплаты.
+    lines: {id товара: количество}. Возвращает False, если товара не хватает."""
+    try:
+        with transaction.atomic():
+            # Сначала запись: в SQLite транзакция, начатая чтением,
+            # не может получить блокировку на запись при конкуренции.
+            StockHold.objects.filter(user=user, item_id__in=lines).update(
+                expires_at=_expires_at())
+            held = dict(
+                StockHold.objects.filter(user=user, item_id__in=lines)
+                .values('item_id').annotate(total=Sum('quantity'))
+                .values_list('item_id', 'total')
+            )
+            for item_id, quantity in lines.items():
+                missing = quantity - held.get(item_id, 0)
+                if missing > 0 and not reserve(user, item_id, missing):
+                    raise OutOfStock
+                if missing < 0:
+                    release(user, item_id, -missing)
+    except OutOfStock:
+        return False
+    return True
+
+
+def commit(user, lines):
+    """Списывает оплаченный товар: удаляет резервы
+    и уменьшает Item.quantity одним запросом."""
+    if not lines:
+        return
+    with transaction.atomic():
+        StockHold.objects.filter(user=user, item_id__in=lines).delete()
+        Item.objects.filter(id__in=lines).update(quantity=F('quantity') - Case(
+            *[When(id=item_id, then=Value(quantity)) for item_id, quantity in lines.items()],
+            output_field=IntegerField(),
+        ))
+
+
+def release_expired(batch_size=500):
+    """Возвращает в остаток просроченные резервы. Возвращает их количество."""
+    released = 0
+    while True:
+        with transaction.atomic():
+            expired = list(
+                StockHold.objects.select_for_update(skip_locked=True)
+                .filter(expires_at__lt=timezone.now())
+                .values_list('id', 'item_id', 'shard', 'quantity')[:batch_size]
+            )
+            if not expired:
+                return released
+            returned = defaultdict(lambda: defaultdict(int))
+            for _, item_id, number, quantity in expired:
+                returned[item_id][number] += quantity
+            StockHold.objects.filter(pk__in=[hold[0] for hold in expired]).delete()
+            for item_id, shards in returned.items():
+                _give_back(item_id, shards)
+        released += len(expired)
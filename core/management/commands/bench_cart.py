@@ -0,0 +1,77 @@
+import threading
+import time
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from core import cart
+from core.models import Category, Item, OrderItem
+
+
+class Command(BaseCommand):
+    help = ('Нагрузочный тест корзины: несколько потоков одновременно добавляют '
+            'один и тот же товар в корзину одного пользователя и проверяют, '
+            'что ни одно добавление не потерялось.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--operations', type=int, default=50,
+                            help='Количество добавлений в каждом потоке')
+
+    def handle(self, *args, **options):
+        if connection.vendor == 'sqlite' and connection.settings_dict['NAME'] == ':memory:':
+            raise CommandError('Для теста нужна файловая база данных.')
+
+        threads_count = options['threads']
+        operations = options['operations']
+        suffix = uuid.uuid4().hex[:8]
+
+        user = get_user_model().objects.create_user(f'bench_cart_{suffix}')
+        category = Category.objects.create(title=f'bench_cart_{suffix}')
+        item = Item.objects.create(
+            title='Bench item', price=10, category=category, label='Новинка',
+            slug=f'bench-cart-{suffix}', description='Bench item', image='bench.jpg',
+            quantity=threads_count * operations
+        )
+        errors = []
+        completed = []
+
+        def worker():
+            done = 0
+            try:
+                for _ in range(operations):
+                    cart.add_item_to_cart(user, item)
+                    done += 1
+            except Exception as e:
+                errors.append(e)
+            finally:
+                completed.append(done)
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(threads_count)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        try:
+            expected = sum(completed)
+            quantity = sum(OrderItem.objects.filter(
+                order__user=user, order__ordered=False, item=item
+            ).values_list('quantity', flat=True))
+            self.stdout.write(
+                f'{expected} operations in {elapsed:.2f}s '
+                f'({expected / elapsed:.0f} ops/s), {len(errors)} failed threads')
+            if errors:
+                self.stdout.write(self.style.ERROR(f'First error: {errors[0]!r}'))
+            if quantity != expected:
+                raise CommandError(
+                    f'Lost updates: expected {expected}, got {quantity}')
+            self.stdout.write(self.style.SUCCESS('No lost updates'))
+        finally:
+            user.delete()
+            category.delete()
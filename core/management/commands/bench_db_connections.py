@@ -0,0 +1,81 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connections
+from django.db.backends.signals import connection_created
+from django.test import Client
+from django.urls import reverse
+
+from core.models import Item
+
+
+class Command(BaseCommand):
+    help = ('Сравнивает число запросов в секунду с новым соединением с базой '
+            'на каждый запрос (CONN_MAX_AGE = 0) и с постоянными соединениями. '
+            'Запускать с настройками production, чтобы соединения шли к postgres '
+            'или pgbouncer, как у gunicorn.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500,
+                            help='Количество запросов в каждом потоке')
+        parser.add_argument('--threads', type=int, default=4)
+        parser.add_argument('--max-age', type=int, default=60,
+                            help='CONN_MAX_AGE для постоянных соединений')
+
+    def _paths(self):
+        slugs = list(Item.objects.values_list('slug', flat=True)[:20])
+        if not slugs:
+            raise CommandError('В каталоге нет товаров.')
+        # Короткие запросы, в которых установка соединения заметнее всего.
+        return ([reverse('core:product', kwargs={'slug': slug}) for slug in slugs]
+                + [reverse('core:add-to-cart', kwargs={'slug': slug}) for slug in slugs])
+
+    def _run(self, paths, requests_count, threads_count):
+        opened = []
+
+        def count_connection(sender, connection, **kwargs):
+            opened.append(connection.alias)
+
+        def worker():
+            client = Client()
+            try:
+                for i in range(requests_count):
+                    # Test Client не закрывает соединения, как обработчик
+                    # запросов gunicorn: делаем это сами в начале и в конце.
+                    # Представления корзины возвращают на HTTP_REFERER.
+                    close_old_connections()
+                    client.get(paths[i % len(paths)], HTTP_REFERER='/')
+                    close_old_connections()
+            finally:
+                connections.close_all()
+
+        connection_created.connect(count_connection)
+        threads = [threading.Thread(target=worker) for _ in range(threads_count)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        connection_created.disconnect(count_connection)
+        return requests_count * threads_count / elapsed, len(opened)
+
+    def handle(self, *args, **options):
+        paths = self._paths()
+        settings_dict = connections['default'].settings_dict
+        initial = {key: settings_dict.get(key) for key in ('CONN_MAX_AGE', 'CONN_HEALTH_CHECKS')}
+        connections.close_all()
+        scenarios = (
+            ('new connection per request', 0, False),
+            ('persistent connections', options['max_age'], False),
+            ('persistent + health checks', options['max_age'], True),
+        )
+        try:
+            for title, max_age, health_checks in scenarios:
+                settings_dict['CONN_MAX_AGE'] = max_age
+                settings_dict['CONN_HEALTH_CHECKS'] = health_checks
+                rate, opened = self._run(paths, options['requests'], options['threads'])
+                self.stdout.write(f'{title}: {rate:.1f} req/s, {opened} connections opened')
+        finally:
+            settings_dict.update(initial)
@@ -0,0 +1,70 @@
+import random
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+from core.models import Category, Item
+
+
+class Command(BaseCommand):
+    help = ('Проверка микрокэша nginx: анонимные запросы к страницам каталога '
+            'и запросы с cookie сессии, выводит долю попаданий в кэш '
+            'по заголовку X-Cache-Status.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://localhost:1337',
+                            help='Адрес nginx')
+        parser.add_argument('--host', default=settings.PROXY_CACHE_HOST,
+                            help='Заголовок Host запросов, должен быть в ALLOWED_HOSTS')
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, default=8)
+
+    def _paths(self):
+        paths = [reverse('core:home')]
+        paths += [reverse('core:products-by-category', kwargs={'id': pk})
+                  for pk in Category.objects.values_list('pk', flat=True)[:10]]
+        paths += [reverse('core:product', kwargs={'slug': slug})
+                  for slug in Item.objects.values_list('slug', flat=True)[:50]]
+        titles = Item.objects.values_list('title', flat=True)[:10]
+        paths += [f"{reverse('core:search')}?{urlencode({'q': title.split()[0]})}"
+                  for title in titles if title.split()]
+        return paths
+
+    def _run(self, url, host, paths, total, concurrency, cookies):
+        session = requests.Session()
+        session.headers['Host'] = host
+        session.cookies.update(cookies)
+
+        def fetch(path):
+            started = time.perf_counter()
+            response = session.get(url + path, allow_redirects=False)
+            return response.headers.get('X-Cache-Status', 'NONE'), time.perf_counter() - started
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(fetch, (random.choice(paths) for _ in range(total))))
+        statuses = Counter(status for status, _ in results)
+        latencies = sorted(elapsed for _, elapsed in results)
+        return statuses, latencies
+
+    def handle(self, *args, **options):
+        paths = self._paths()
+        if not paths:
+            raise CommandError('В каталоге нет страниц.')
+        url = options['url'].rstrip('/')
+
+        for title, cookies in (('anonymous', {}), ('with session cookie', {'sessionid': 'bench'})):
+            statuses, latencies = self._run(
+                url, options['host'], paths, options['requests'], options['concurrency'], cookies)
+            hits = statuses['HIT'] + statuses['REVALIDATED'] + statuses['STALE'] + statuses['UPDATING']
+            p50 = latencies[len(latencies) // 2] * 1000
+            p95 = latencies[int(len(latencies) * 0.95)] * 1000
+            self.stdout.write(
+                f'{title}: {len(paths)} pages, {options["requests"]} requests, '
+                f'hit ratio {hits / options["requests"]:.0%}, '
+                f'p50 {p50:.1f}ms, p95 {p95:.1f}ms, {dict(statuses)}')
@@ -0,0 +1,57 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.cache import bump_version
+from core.images import build_variants
+from core.models import Item
+
+
+class Command(BaseCommand):
+    help = ('Создает уменьшенные копии изображений товаров (см. core/images.py) '
+            'в пуле процессов и сохраняет их хэши.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Количество процессов')
+        parser.add_argument('--all', action='store_true',
+                            help='Проверить и товары, у которых копии уже есть')
+
+    def handle(self, *args, **options):
+        items = Item.objects.exclude(image='').only('id', 'image', 'image_hash')
+        if not options['all']:
+            items = items.filter(image_hash='')
+        items = {item.pk: item for item in items}
+        if not items:
+            self.stdout.write('Нет товаров без копий изображений.')
+            return
+
+        changed, failed = [], 0
+        # Процессы только пишут файлы, запросы к базе выполняет этот процесс.
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            futures = {
+                executor.submit(build_variants, item.image.path,
+                                settings.MEDIA_ROOT, settings.IMAGE_VARIANT_WIDTHS): item
+                for item in items.values()
+            }
+            for future in as_completed(futures):
+                item = futures[future]
+                try:
+                    image_hash = future.result()
+                except (OSError, ValueError) as e:
+                    failed += 1
+                    self.stderr.write(f'{item.image.name}: {e}')
+                    continue
+                if image_hash != item.image_hash:
+                    item.image_hash = image_hash
+                    item.updated_at = timezone.now()
+                    changed.append(item)
+
+        Item.objects.bulk_update(changed, ['image_hash', 'updated_at'], batch_size=500)
+        if changed:
+            bump_version('catalog')
+        self.stdout.write(self.style.SUCCESS(
+            f'Обработано {len(items)} товаров, обновлено {len(changed)}, ошибок {failed}.'))
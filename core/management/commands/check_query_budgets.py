@@ -0,0 +1,263 @@
+import re
+import threading
+import uuid
+from collections import Counter
+from http.server import ThreadingHTTPServer
+
+import stripe
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.http import HttpResponse
+from django.test import Client, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import resolve, reverse
+from django.utils import timezone
+
+from core import cart
+from core.fake_stripe import FakeStripeHandler
+from core.models import Address, Category, Coupon, Item, Order, PaymentJob
+from core.query_budget import QueryLog, get_budget
+from core.services import coupons_local_cache
+from core.urls import urlpatterns
+
+
+# Отдельный кэш на время проверки: перед каждым замером он очищается,
+# поэтому измеряется худший случай - без закэшированных данных.
+ISOLATED_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'check-query-budgets',
+    },
+}
+
+# Список параметров IN (%s, %s, ...).
+IN_LIST_RE = re.compile(r'IN \(%s(, %s)*\)')
+
+
+def _shape(sql):
+    """SQL без длины списков IN: такой запрос не считается лишним,
+    если в большом замере у него просто больше параметров."""
+    return IN_LIST_RE.sub('IN (...)', sql)
+
+
+def _size(value):
+    items, lines = (int(part) for part in value.split(':'))
+    # Кроме товаров в корзине нужны два товара для новых позиций.
+    if lines < 1 or items < lines + 2:
+        raise ValueError(value)
+    return items, lines
+
+
+class Command(BaseCommand):
+    help = ('Проверяет бюджеты запросов к базе (core/query_budget.py) у всех '
+            'представлений core/urls.py и основных функций корзины. Каждый '
+            'сценарий выполняется на каталоге и корзине разного размера: число '
+            'запросов должно укладываться в бюджет и не зависеть от размера. '
+            'При превышении выводит SQL со стеками вызовов и завершается с ошибкой. '
+            'Данные создаются в транзакции, которая откатывается.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=_size, nargs='+', default=[(3, 1), (40, 15)],
+                            help='Размеры данных "товаров:позиций в корзине", '
+                                 'товаров хотя бы на два больше, чем позиций')
+
+    def _fixture(self, items_count, lines_count):
+        suffix = uuid.uuid4().hex[:8]
+        category = Category.objects.create(title=f'query budget {suffix}')
+        # create(), а не bulk_create(): сигналы заполняют остаток и поисковый индекс.
+        items = [
+            Item.objects.create(
+                title=f'Товар qb{suffix} {number}', price=100,
+                discount_price=90 if number % 2 else None, category=category,
+                label='Новинка', slug=f'query-budget-{suffix}-{number}',
+                description='Товар для проверки бюджетов запросов',
+                # С хэшем копий шаблон не ставит в фон их создание.
+                image='query-budget.jpg', image_hash='0' * 16, quantity=100,
+            )
+            for number in range(items_count)
+        ]
+        user = get_user_model().objects.create_user(
+            f'query_budget_{suffix}', f'query_budget_{suffix}@example.com')
+        for item in items[:lines_count]:
+            cart.add_item_to_cart(user, item)
+        for address_type in ('S', 'B'):
+            Address.objects.create(
+                user=user, street_address='ул. Тестовая, 1', apartment_address='1',
+                country='RU', zip='101000', address_type=address_type, default=True)
+        coupon = Coupon.objects.create(code=f'QB{suffix}', amount=1)
+        order = Order.objects.get(user=user, ordered=False)
+        past_order = Order.objects.create(
+            user=get_user_model().objects.create_user(f'query_budget_past_{suffix}'),
+            ordered=True, ordered_date=timezone.now(), reference_code=f'qb{suffix}')
+        job = PaymentJob.objects.create(
+            idempotency_key=f'query-budget-{suffix}', user=user, order=order, amount=1)
+
+        client = Client()
+        client.force_login(user)
+        # Cookie корзины записывается сразу: при добавлении через представление
+        # непрочитанные сообщения переполнили бы cookie сообщений и ушли бы
+        # в сессию, и число запросов анонимных страниц зависело бы от размера.
+        anonymous = Client()
+        response = HttpResponse()
+        anonymous_cart = cart.AnonymousCart({item.pk: 1 for item in items[:lines_count]})
+        anonymous_cart.modified = True
+        anonymous_cart.save(response)
+        anonymous.cookies.update(response.cookies)
+        return {
+            'suffix': suffix, 'category': category, 'items': items, 'lines': lines_count,
+            'user': user, 'order': order, 'coupon': coupon, 'past_order': past_order,
+            'job': job, 'client': client, 'anonymous': anonymous,
+        }
+
+    def _view(self, title, client, method, name, kwargs=None, data=None, status=200):
+        """Сценарий запроса к представлению: (название, имя url, бюджет, функция)."""
+        path = reverse(f'core:{name}', kwargs=kwargs)
+
+        def run():
+            # Представления корзины возвращают на HTTP_REFERER.
+            response = getattr(client, method.lower())(path, data or {}, HTTP_REFERER='/')
+            if response.status_code != status:
+                raise CommandError(
+                    f'{title}: ответ {response.status_code} вместо {status}, '
+                    f'сценарий не выполнился.')
+
+        return title, name, get_budget(resolve(path).func, method), run
+
+    @staticmethod
+    def _service(title, func, run):
+        return title, None, getattr(func, 'query_budget', None), run
+
+    def _scenarios(self, data):
+        """Сценарии в порядке выполнения: изменения корзины идут
+        до оплаты, после нее у пользователя нет активной корзины."""
+        client, anonymous, items, lines = data['client'], data['anonymous'], data['items'], data['lines']
+        in_cart, new = items[0], items[lines]
+        return [
+            self._view('home (anonymous)', anonymous, 'GET', 'home'),
+            self._view('home', client, 'GET', 'home'),
+            self._view('products-by-category', client, 'GET', 'products-by-category',
+                       {'id': data['category'].pk}),
+            self._view('search', client, 'GET', 'search', data={'q': f'qb{data["suffix"]}'}),
+            self._view('product', client, 'GET', 'product', {'slug': in_cart.slug}),
+            self._view('add-to-cart (new line)', client, 'GET', 'add-to-cart',
+                       {'slug': new.slug}, status=302),
+            self._view('add-to-cart', client, 'GET', 'add-to-cart',
+                       {'slug': in_cart.slug}, status=302),
+            self._view('remove-single-item-from-cart', client, 'GET',
+                       'remove-single-item-from-cart', {'slug': in_cart.slug}, status=302),
+            self._view('remove-from-cart', client, 'GET', 'remove-from-cart',
+                       {'slug': new.slug}, status=302),
+            self._service('cart.add_item_to_cart (new line)', cart.add_item_to_cart,
+                          lambda: cart.add_item_to_cart(data['user'], items[lines + 1])),
+            self._service('cart.add_item_to_cart', cart.add_item_to_cart,
+                          lambda: cart.add_item_to_cart(data['user'], in_cart)),
+            self._service('Order.get_total', Order.get_total, data['order'].get_total),
+            self._view('order-summary (anonymous)', anonymous, 'GET', 'order-summary'),
+            self._view('order-summary', client, 'GET', 'order-summary'),
+            self._view('checkout', client, 'GET', 'checkout'),
+            self._view('add-coupon', client, 'POST', 'add-coupon',
+                       data={'code': data['coupon'].code}, status=302),
+            self._view('checkout POST', client, 'POST', 'checkout', data={
+                'use_default_shipping': 'on', 'use_default_billing': 'on',
+                'payment_option': 'S',
+            }, status=302),
+            self._view('payment', client, 'GET', 'payment', {'payment_option': 'stripe'}),
+            self._view('payment POST', client, 'POST', 'payment', {'payment_option': 'stripe'},
+                       data={'stripeToken': 'tok_visa'}, status=302),
+            self._view('payment-status', client, 'GET', 'payment-status',
+                       {'key': data['job'].idempotency_key}),
+            self._view('request-refund', client, 'GET', 'request-refund'),
+            self._view('request-refund POST', client, 'POST', 'request-refund', data={
+                'reference_code': data['past_order'].reference_code,
+                'message': 'Проверка', 'email': 'query-budget@example.com',
+            }, status=302),
+        ]
+
+    def _measure(self, size):
+        """Выполняет сценарии на данных размера size, возвращает
+        [(название, имя url, бюджет, QueryLog)]. Данные откатываются."""
+        results = []
+        with transaction.atomic():
+            data = self._fixture(*size)
+            for title, name, budget, run in self._scenarios(data):
+                cache.clear()
+                coupons_local_cache.clear()
+                with QueryLog() as log:
+                    run()
+                results.append((title, name, budget, log))
+            if not Order.objects.filter(pk=data['order'].pk, ordered=True).exists():
+                raise CommandError('Оплата не прошла, сценарии после нее не проверены.')
+            transaction.set_rollback(True)
+        return results
+
+    def _run(self, sizes):
+        # Оплата идет в локальную заглушку Stripe.
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FakeStripeHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        api_base = stripe.api_base
+        stripe.api_base = f'http://127.0.0.1:{server.server_address[1]}'
+        setup_test_environment(debug=False)
+        try:
+            with override_settings(CACHES=ISOLATED_CACHES, PAYMENT_ASYNC=False):
+                return [self._measure(size) for size in sizes]
+        finally:
+            teardown_test_environment()
+            stripe.api_base = api_base
+            server.shutdown()
+            server.server_close()
+
+    @staticmethod
+    def _growth(title, counts, budget, logs):
+        """Описание роста числа запросов с размером данных: запросы
+        самого большого замера сверх самого маленького, со стеками."""
+        declared = f'budget {budget.queries}' if budget else 'budget is not declared'
+        lines = [f'{title}: grows with data size ({counts}), {declared}']
+        smallest = min(logs, key=len)
+        extra = Counter(_shape(query.sql) for query in logs[-1].queries)
+        extra.subtract(_shape(query.sql) for query in smallest.queries)
+        for query in logs[-1].queries:
+            if extra[_shape(query.sql)] > 0:
+                extra[_shape(query.sql)] -= 1
+                lines.append(f'{query.sql}\n{query.stack}')
+        return '\n'.join(lines)
+
+    def handle(self, *args, **options):
+        sizes = options['sizes']
+        runs = self._run(sizes)
+        failed = []
+        checked = set()
+        labels = [f'{items}:{lines}' for items, lines in sizes]
+
+        for results in zip(*runs):
+            title, name, budget, _ = results[0]
+            logs = [log for _, _, _, log in results]
+            checked.add(name)
+            counts = ', '.join(f'{label} -> {len(log)}' for label, log in zip(labels, logs))
+            reports = []
+            if budget is None:
+                reports.append(f'{title}: query budget is not declared')
+            else:
+                reports.extend(filter(None, (
+                    log.overruns(budget, f'{title} [{label}]') for label, log in zip(labels, logs))))
+            if len({len(log) for log in logs}) > 1:
+                reports.append(self._growth(title, counts, budget, logs))
+
+            if reports:
+                failed.append(title)
+                self.stdout.write(f'{self.style.ERROR("FAIL")} {title}: {counts} queries')
+                self.stdout.write('\n'.join(reports))
+            else:
+                self.stdout.write(
+                    f'{self.style.SUCCESS("OK")} {title}: {counts} queries, '
+                    f'budget {budget.queries}, {max(log.duplicates for log in logs)} '
+                    f'duplicates of {budget.duplicates}')
+
+        unchecked = [pattern.name for pattern in urlpatterns if pattern.name not in checked]
+        if unchecked:
+            failed.extend(unchecked)
+            self.stdout.write(f'{self.style.ERROR("FAIL")} no scenario for: {", ".join(unchecked)}')
+        if failed:
+            raise CommandError(f'Превышены или не объявлены бюджеты запросов: {", ".join(failed)}.')
@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from core import cart
+from core.models import Address, Coupon, Order
+
+
+# Признаки поиска по индексу в выводе EXPLAIN.
+INDEX_SCAN_MARKERS = {
+    'postgresql': ('Index Scan', 'Index Only Scan', 'Bitmap Index Scan'),
+    'sqlite': ('USING INDEX', 'USING COVERING INDEX', 'USING PRIMARY KEY',
+               'USING INTEGER PRIMARY KEY'),
+}
+
+
+class Command(BaseCommand):
+    help = ('Проверяет по EXPLAIN, что частые запросы корзины, оформления '
+            'заказа, возврата и промокодов используют индексы. Завершается '
+            'с ошибкой, если какой-то запрос читает всю таблицу.')
+
+    def _hot_queries(self):
+        """(название, queryset, имя индекса или None - подойдет любой)."""
+        return [
+            ('active order', Order.objects.filter(user_id=1, ordered=False),
+             'core_order_one_active_per_user'),
+            ('cart line', cart._cart_lines(1, 1), 'core_orderitem_one_active_per_item'),
+            ('default addresses', Address.objects.filter(user_id=1, default=True),
+             'core_address_one_default_per_type'),
+            ('default address by type',
+             Address.objects.filter(user_id=1, address_type='S', default=True),
+             'core_address_one_default_per_type'),
+            ('order by reference code', Order.objects.filter(reference_code='x'), None),
+            ('coupon by code', Coupon.objects.filter(code='x'), None),
+        ]
+
+    @staticmethod
+    def _full_scan(plan):
+        """Есть ли в плане полный просмотр какой-нибудь таблицы."""
+        if connection.vendor == 'postgresql':
+            return 'Seq Scan' in plan
+        return any('SCAN ' in line and 'USING' not in line for line in plan.splitlines())
+
+    def handle(self, *args, **options):
+        markers = INDEX_SCAN_MARKERS.get(connection.vendor)
+        if markers is None:
+            raise CommandError(f'EXPLAIN для {connection.vendor} не поддерживается.')
+
+        failed = []
+        for title, queryset, index_name in self._hot_queries():
+            with transaction.atomic():
+                if connection.vendor == 'postgresql':
+                    # В почти пустой базе postgres предпочтет полный просмотр
+                    # таблицы, проверяем, что индекс вообще подходит к запросу.
+                    with connection.cursor() as cursor:
+                        cursor.execute('SET LOCAL enable_seqscan = off')
+                plan = queryset.explain()
+            uses_index = any(marker in plan for marker in markers) and not self._full_scan(plan)
+            if index_name is not None:
+                uses_index = uses_index and index_name in plan
+            if not uses_index:
+                failed.append(title)
+            status = self.style.SUCCESS('OK') if uses_index else self.style.ERROR('FAIL')
+            self.stdout.write(f'{status} {title}: {" ".join(plan.split())}')
+
+        if failed:
+            raise CommandError(f'Запросы без подходящего индекса: {", ".join(failed)}.')
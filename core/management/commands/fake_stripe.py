@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from core.fake_stripe import serve
+
+
+class Command(BaseCommand):
+    help = 'Запускает локальную заглушку Stripe API (см. STRIPE_API_BASE)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=12111)
+        parser.add_argument('--latency', type=float, default=0.0,
+                            help='Задержка каждого ответа в секундах')
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.SUCCESS(
+            f'Fake Stripe API on http://{options["host"]}:{options["port"]}'))
+        serve(options['host'], options['port'], options['latency'])
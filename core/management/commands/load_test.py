@@ -0,0 +1,359 @@
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from io import BytesIO
+from urllib.parse import urlencode
+
+import requests
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from core.models import Category, Item
+
+
+PREFIX = 'load-test'
+PASSWORD = 'load-test-password'
+IMAGE_NAME = f'{PREFIX}.jpg'
+
+# Слова для названий товаров и поисковых запросов.
+NOUNS = ('куртка', 'рубашка', 'платье', 'джинсы', 'кеды', 'шарф', 'свитер', 'пальто')
+ADJECTIVES = ('черный', 'белый', 'синий', 'льняной', 'шерстяной', 'летний', 'теплый')
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _percentile(values, percent):
+    """Процентиль по отсортированному списку (nearest rank)."""
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def _summary(samples, elapsed):
+    latencies = sorted(sample[2] * 1000 for sample in samples)
+    queries = [sample[4] for sample in samples if sample[4] is not None]
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for sample in samples if sample[3] is None or sample[3] >= 400),
+        'rps': round(len(samples) / elapsed, 2),
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies), 2),
+            'p50': round(_percentile(latencies, 50), 2),
+            'p95': round(_percentile(latencies, 95), 2),
+            'p99': round(_percentile(latencies, 99), 2),
+            'max': round(latencies[-1], 2),
+        },
+        # Без QUERY_COUNT_HEADER на сервере число запросов неизвестно.
+        'db_queries': {
+            'mean': round(sum(queries) / len(queries), 2),
+            'max': max(queries),
+        } if queries else None,
+    }
+
+
+class Command(BaseCommand):
+    help = ('Нагрузочный тест магазина: создает тестовый каталог и пользователей, '
+            'запускает gunicorn и заглушку Stripe и в несколько потоков проходит '
+            'сценарий покупателя (каталог, поиск, товар, корзина, оформление '
+            'и оплата заказа). Задержки p50/p95/p99, запросы в секунду и число '
+            'запросов к базе по каждой странице сохраняются в JSON, '
+            'чтобы сравнивать результаты разных коммитов.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='Адрес уже запущенного сервера с той же базой. '
+                                          'По умолчанию запускаются gunicorn и заглушка Stripe')
+        parser.add_argument('--users', type=int, default=8,
+                            help='Количество одновременных покупателей')
+        parser.add_argument('--duration', type=float, default=30,
+                            help='Длительность замера в секундах')
+        parser.add_argument('--warmup', type=float, default=5,
+                            help='Секунды в начале теста, которые не попадают в замер')
+        parser.add_argument('--checkout-ratio', type=float, default=0.2,
+                            help='Доля проходов сценария, которые заканчиваются оплатой')
+        parser.add_argument('--categories', type=int, default=10)
+        parser.add_argument('--items', type=int, default=500)
+        parser.add_argument('--seed', type=int, default=1,
+                            help='Начальное значение генератора данных и сценариев')
+        parser.add_argument('--workers', type=int,
+                            help='GUNICORN_WORKERS для запускаемого gunicorn')
+        parser.add_argument('--stripe-latency', type=float, default=0.0,
+                            help='Задержка ответов заглушки Stripe в секундах')
+        parser.add_argument('--output', default='load-test.json')
+
+    def _seed_image(self):
+        """Одно изображение на все тестовые товары: копии создаются один раз."""
+        if not default_storage.exists(IMAGE_NAME):
+            content = BytesIO()
+            Image.new('RGB', (800, 800), (70, 110, 160)).save(content, 'JPEG')
+            default_storage.save(IMAGE_NAME, ContentFile(content.getvalue()))
+
+    def _seed(self, options):
+        """Создает недостающие тестовые данные. При одном и том же --seed
+        данные получаются одинаковыми, повторный запуск их не дублирует."""
+        rng = random.Random(options['seed'])
+        self._seed_image()
+        with transaction.atomic():
+            categories = [
+                Category.objects.get_or_create(title=f'{PREFIX} {number}')[0].pk
+                for number in range(options['categories'])
+            ]
+            existing = set(Item.objects.filter(
+                slug__startswith=f'{PREFIX}-').values_list('slug', flat=True))
+            for number in range(options['items']):
+                # Значения генерируются всегда, чтобы не зависеть от уже созданных товаров.
+                title = f'{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} {number}'.capitalize()
+                price = rng.randrange(500, 20000)
+                discount_price = price * rng.choice((0, 0, 0, 80, 90)) // 100 or None
+                category = rng.choice(categories)
+                slug = f'{PREFIX}-{number}'
+                if slug in existing:
+                    continue
+                # create(), а не bulk_create(): сигналы заполняют остаток
+                # и поисковый индекс.
+                Item.objects.create(
+                    title=title, price=price, discount_price=discount_price,
+                    category_id=category, label=rng.choice(('Новинка', 'Сезон', 'Скидка')),
+                    slug=slug, description=f'{title}. Товар для нагрузочного теста.',
+                    image=IMAGE_NAME, quantity=10 ** 6,
+                )
+
+            user_model = get_user_model()
+            usernames = [f'{PREFIX}-{number}' for number in range(options['users'])]
+            existing = set(user_model.objects.filter(
+                username__in=usernames).values_list('username', flat=True))
+            for username in usernames:
+                if username not in existing:
+                    user_model.objects.create_user(
+                        username, f'{username}@example.com', PASSWORD)
+
+        slugs = [f'{PREFIX}-{number}' for number in range(options['items'])]
+        return categories, slugs, usernames
+
+    def _start_servers(self, options):
+        """Запускает заглушку Stripe и gunicorn с теми же настройками Django."""
+        stripe_port = _free_port()
+        port = _free_port()
+        env = dict(
+            os.environ,
+            DJANGO_SETTINGS_MODULE=settings.SETTINGS_MODULE,
+            STRIPE_API_BASE=f'http://127.0.0.1:{stripe_port}',
+            GUNICORN_BIND=f'127.0.0.1:{port}',
+            QUERY_COUNT_HEADER='True',
+        )
+        if options['workers']:
+            env['GUNICORN_WORKERS'] = str(options['workers'])
+        processes = [
+            subprocess.Popen(
+                [sys.executable, '-m', 'django', 'fake_stripe', '--port', str(stripe_port),
+                 '--latency', str(options['stripe_latency'])],
+                cwd=settings.BASE_DIR, env=env, stdout=subprocess.DEVNULL),
+            # Журнал запросов gunicorn пишет в stdout, ошибки остаются в stderr.
+            subprocess.Popen(
+                [sys.executable, '-m', 'gunicorn', '-c', 'config/gunicorn.py',
+                 'config.wsgi:application'],
+                cwd=settings.BASE_DIR, env=env, stdout=subprocess.DEVNULL),
+        ]
+        return f'http://127.0.0.1:{port}', processes
+
+    @staticmethod
+    def _stop_servers(processes):
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    @staticmethod
+    def _wait_ready(url, processes, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if any(process.poll() is not None for process in processes):
+                raise CommandError('Сервер завершился при запуске, см. вывод выше.')
+            try:
+                requests.get(url + reverse('core:home'), timeout=5)
+                return
+            except requests.ConnectionError:
+                time.sleep(0.2)
+        raise CommandError(f'Сервер не ответил за {timeout} секунд.')
+
+    @staticmethod
+    def _login(session, url, username):
+        login_url = url + reverse('account_login')
+        session.get(login_url)
+        response = session.post(login_url, allow_redirects=False, data={
+            'login': username,
+            'password': PASSWORD,
+            'csrfmiddlewaretoken': session.cookies.get('csrftoken', ''),
+        })
+        if response.status_code != 302:
+            raise CommandError(f'Не удалось войти как {username}: {response.status_code}.')
+
+    @staticmethod
+    def _request(session, samples, route, method, url, **kwargs):
+        """Выполняет запрос и записывает (время начала, страница, длительность,
+        код ответа или None при ошибке соединения, число запросов к базе)."""
+        if method == 'POST':
+            # Токен CSRF меняется при входе, берем текущий из cookie.
+            kwargs['headers'] = {'X-CSRFToken': session.cookies.get('csrftoken', '')}
+        started = time.monotonic()
+        try:
+            response = session.request(method, url, allow_redirects=False, timeout=30, **kwargs)
+        except requests.RequestException:
+            samples.append((started, route, time.monotonic() - started, None, None))
+            return None
+        queries = response.headers.get('X-DB-Queries')
+        samples.append((started, route, time.monotonic() - started, response.status_code,
+                        int(queries) if queries is not None else None))
+        return response
+
+    def _scenario(self, session, samples, url, rng, categories, slugs, checkout_ratio):
+        """Один проход покупателя по магазину."""
+        self._request(session, samples, 'home', 'GET', url + reverse('core:home'))
+        self._request(session, samples, 'category', 'GET', url + reverse(
+            'core:products-by-category', kwargs={'id': rng.choice(categories)}))
+        query = urlencode({'q': f'{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)[:4]}'})
+        self._request(session, samples, 'search', 'GET', f"{url}{reverse('core:search')}?{query}")
+
+        slug = rng.choice(slugs)
+        product_url = url + reverse('core:product', kwargs={'slug': slug})
+        self._request(session, samples, 'product', 'GET', product_url)
+        # Представления корзины возвращают на HTTP_REFERER.
+        self._request(session, samples, 'add-to-cart', 'GET',
+                      url + reverse('core:add-to-cart', kwargs={'slug': slug}),
+                      headers={'Referer': product_url})
+        self._request(session, samples, 'order-summary', 'GET', url + reverse('core:order-summary'))
+        if rng.random() >= checkout_ratio:
+            return
+
+        checkout_url = url + reverse('core:checkout')
+        self._request(session, samples, 'checkout', 'GET', checkout_url)
+        self._request(session, samples, 'checkout-submit', 'POST', checkout_url, data={
+            'shipping_address': 'ул. Тестовая, 1',
+            'shipping_country': 'RU',
+            'shipping_zip': '101000',
+            'same_billing_address': 'on',
+            'payment_option': 'P',
+        })
+        payment_url = url + reverse('core:payment', kwargs={'payment_option': 'stripe'})
+        self._request(session, samples, 'payment', 'GET', payment_url)
+        response = self._request(session, samples, 'payment-submit', 'POST', payment_url,
+                                 data={'stripeToken': 'tok_visa'})
+        # С PAYMENT_ASYNC оплата перенаправляет на страницу статуса.
+        location = response.headers.get('Location', '') if response is not None else ''
+        if '/payment/status/' in location:
+            self._request(session, samples, 'payment-status', 'GET', url + location)
+
+    def _run(self, url, categories, slugs, usernames, options):
+        samples = []
+        errors = []
+        window = {}
+
+        def start_clock():
+            # Замер начинается, когда все покупатели вошли.
+            window['from'] = time.monotonic() + options['warmup']
+            window['to'] = window['from'] + options['duration']
+
+        barrier = threading.Barrier(len(usernames), action=start_clock)
+
+        def virtual_user(number, username):
+            rng = random.Random(options['seed'] * 1000 + number)
+            session = requests.Session()
+            try:
+                self._login(session, url, username)
+                barrier.wait()
+                while time.monotonic() < window['to']:
+                    self._scenario(session, samples, url, rng, categories, slugs,
+                                   options['checkout_ratio'])
+            except Exception as e:
+                errors.append(e)
+                barrier.abort()
+            finally:
+                session.close()
+
+        threads = [threading.Thread(target=virtual_user, args=(number, username))
+                   for number, username in enumerate(usernames)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            # BrokenBarrierError - следствие ошибки другого покупателя.
+            error = next((e for e in errors if not isinstance(e, threading.BrokenBarrierError)),
+                         errors[0])
+            raise CommandError(f'Ошибка покупателя: {error!r}')
+        return [sample for sample in samples if window['from'] <= sample[0] < window['to']]
+
+    def _report(self, samples, options, url):
+        if not samples:
+            raise CommandError('Не выполнено ни одного запроса.')
+        elapsed = options['duration']
+        routes = {}
+        for sample in samples:
+            routes.setdefault(sample[1], []).append(sample)
+        try:
+            commit = subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+        return {
+            'commit': commit,
+            'started_at': timezone.now().isoformat(),
+            'url': url,
+            'database': connection.vendor,
+            'payment_async': settings.PAYMENT_ASYNC,
+            'options': {key: options[key] for key in (
+                'users', 'duration', 'warmup', 'checkout_ratio', 'categories',
+                'items', 'seed', 'workers', 'stripe_latency')},
+            'routes': {route: _summary(route_samples, elapsed)
+                       for route, route_samples in routes.items()},
+            'total': _summary(samples, elapsed),
+        }
+
+    def handle(self, *args, **options):
+        if options['users'] < 1 or options['duration'] <= 0:
+            raise CommandError('Нужен хотя бы один покупатель и положительная длительность.')
+        categories, slugs, usernames = self._seed(options)
+        # Сервер работает со своими соединениями, наше больше не нужно.
+        connection.close()
+
+        processes = []
+        url = options['url']
+        try:
+            if url is None:
+                url, processes = self._start_servers(options)
+                self._wait_ready(url, processes)
+            url = url.rstrip('/')
+            samples = self._run(url, categories, slugs, usernames, options)
+        finally:
+            self._stop_servers(processes)
+
+        report = self._report(samples, options, url)
+        with open(options['output'], 'w') as output:
+            json.dump(report, output, ensure_ascii=False, indent=2, sort_keys=True)
+
+        for route, summary in sorted(report['routes'].items()) + [('total', report['total'])]:
+            latency = summary['latency_ms']
+            queries = summary['db_queries']['mean'] if summary['db_queries'] else '-'
+            self.stdout.write(
+                f'{route}: {summary["requests"]} requests, {summary["rps"]} req/s, '
+                f'p50 {latency["p50"]}ms, p95 {latency["p95"]}ms, p99 {latency["p99"]}ms, '
+                f'{queries} queries, {summary["errors"]} errors')
+        self.stdout.write(self.style.SUCCESS(f'Results saved to {options["output"]}'))
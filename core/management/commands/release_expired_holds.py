@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.inventory import release_expired
+
+
+class Command(BaseCommand):
+    help = 'Возвращает в остаток просроченные резервы товара'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=0,
+                            help='Повторять каждые N секунд (по умолчанию выполнить один раз)')
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        while True:
+            released = release_expired()
+            self.stdout.write(self.style.SUCCESS(f'Released {released} expired holds'))
+            if not interval:
+                break
+            time.sleep(interval)
@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.payment_queue import run_worker
+
+
+class Command(BaseCommand):
+    help = 'Выполняет задачи асинхронной оплаты заказов (PAYMENT_ASYNC)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=settings.PAYMENT_WORKER_CONCURRENCY,
+                            help='Количество одновременных запросов к Stripe')
+        parser.add_argument('--poll-interval', type=float, default=1.0)
+        parser.add_argument('--once', action='store_true',
+                            help='Завершиться, когда очередь опустеет')
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.SUCCESS(
+            f'Payment worker started, concurrency {options["concurrency"]}'))
+        run_worker(options['concurrency'], options['poll_interval'], options['once'])
@@ -0,0 +1,170 @@
+"""
+Метрики Prometheus.
+
+MetricsMiddleware (core/middleware.py) для каждого запроса записывает
+в гистограммы по имени маршрута время ответа, число и время запросов
+к базе, время шаблонов и обращений к Stripe. Время шаблонов считает
+шаблонный бэкенд TimedDjangoTemplates, время Stripe - stripe_gateway.
+Сбор включается настройкой METRICS_ENABLED.
+
+Процессы gunicorn пишут значения в файлы каталога METRICS_DIR (режим
+multiprocess prometheus_client), /metrics суммирует их по всем процессам.
+Каталог очищается при запуске gunicorn (config/gunicorn.py). Без
+METRICS_DIR каждый процесс отдает только свои метрики.
+"""
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.template.backends.django import DjangoTemplates
+
+if settings.METRICS_DIR:
+    # prometheus_client выбирает режим при импорте.
+    os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', settings.METRICS_DIR)
+
+from prometheus_client import (  # noqa: E402
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, REGISTRY,
+    generate_latest, multiprocess,
+)
+
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+# Метод запроса в метке, остальные методы попадают в other.
+METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+# Границы корзин гистограмм времени в секундах.
+TIME_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', 'Время ответа на запрос',
+    ('route', 'method', 'status'), buckets=TIME_BUCKETS)
+REQUEST_DB_QUERIES = Histogram(
+    'http_request_db_queries', 'Число запросов к базе за запрос',
+    ('route',), buckets=(0, 1, 2, 5, 10, 20, 50, 100))
+REQUEST_DB_SECONDS = Histogram(
+    'http_request_db_seconds', 'Время запросов к базе за запрос',
+    ('route',), buckets=TIME_BUCKETS)
+REQUEST_TEMPLATE_SECONDS = Histogram(
+    'http_request_template_seconds', 'Время отрисовки шаблонов за запрос',
+    ('route',), buckets=TIME_BUCKETS)
+REQUEST_STRIPE_SECONDS = Histogram(
+    'http_request_stripe_seconds', 'Время обращений к Stripe за запрос, '
+    'только для запросов, которые к нему обращались', ('route',), buckets=TIME_BUCKETS)
+STRIPE_SECONDS = Histogram(
+    'stripe_request_duration_seconds', 'Время вызова Stripe API с повторами',
+    ('operation',), buckets=TIME_BUCKETS)
+STRIPE_ERRORS = Counter(
+    'stripe_request_errors', 'Вызовы Stripe API, завершившиеся ошибкой', ('operation',))
+
+# Счетчики текущего запроса. В воркерах gevent threading.local
+# пропатчен и хранит значения отдельно для каждого гринлета.
+_local = threading.local()
+
+
+class RequestStats:
+    """Счетчики одного запроса."""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+        self.stripe_seconds = 0.0
+        self.rendering = False
+
+    def time_query(self, execute, sql, params, many, context):
+        """Обертка connection.execute_wrapper."""
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_seconds += time.perf_counter() - started
+
+
+def start_request():
+    _local.stats = RequestStats()
+    return _local.stats
+
+
+def finish_request():
+    _local.stats = None
+
+
+def _current():
+    return getattr(_local, 'stats', None)
+
+
+def _route(request):
+    # Имя маршрута, а не путь: число меток не растет вместе с каталогом.
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else 'unmatched'
+
+
+def observe_request(request, response, elapsed, stats):
+    route = _route(request)
+    method = request.method if request.method in METHODS else 'other'
+    REQUEST_SECONDS.labels(route, method, f'{response.status_code // 100}xx').observe(elapsed)
+    REQUEST_DB_QUERIES.labels(route).observe(stats.queries)
+    REQUEST_DB_SECONDS.labels(route).observe(stats.db_seconds)
+    REQUEST_TEMPLATE_SECONDS.labels(route).observe(stats.template_seconds)
+    if stats.stripe_seconds:
+        REQUEST_STRIPE_SECONDS.labels(route).observe(stats.stripe_seconds)
+
+
+def observe_stripe(operation, elapsed, failed):
+    """Вызывается stripe_gateway после каждого вызова API,
+    в том числе вне запросов (воркер оплаты)."""
+    if not settings.METRICS_ENABLED:
+        return
+    STRIPE_SECONDS.labels(operation).observe(elapsed)
+    if failed:
+        STRIPE_ERRORS.labels(operation).inc()
+    stats = _current()
+    if stats is not None:
+        stats.stripe_seconds += elapsed
+
+
+def export():
+    """Метрики всех процессов в текстовом формате Prometheus."""
+    if not settings.METRICS_DIR:
+        return generate_latest(REGISTRY)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+
+class TimedTemplate:
+    """Шаблон, время отрисовки которого попадает в метрики запроса.
+    Шаблоны, которые отрисовываются внутри другого ({% include %},
+    формы crispy), отдельно не считаются."""
+
+    def __init__(self, template):
+        # Не self.template: атрибут template есть у самого шаблона бэкенда.
+        self._timed = template
+
+    def __getattr__(self, name):
+        return getattr(self._timed, name)
+
+    def render(self, context=None, request=None):
+        stats = _current()
+        if stats is None or stats.rendering:
+            return self._timed.render(context, request)
+        stats.rendering = True
+        started = time.perf_counter()
+        try:
+            return self._timed.render(context, request)
+        finally:
+            stats.rendering = False
+            stats.template_seconds += time.perf_counter() - started
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """Шаблонный бэкенд Django, который считает время отрисовки шаблонов."""
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
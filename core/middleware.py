@@ -0,0 +1,73 @@
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.utils.functional import SimpleLazyObject
+
+from core import cart, metrics
+
+
+class CartMiddleware:
+    """Добавляет к запросу корзину посетителя request.cart: корзину
+    пользователя в базе или анонимную корзину в cookie. Анонимная корзина
+    доступна и как request.anonymous_cart, чтобы перенести ее при входе."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.anonymous_cart = cart.AnonymousCart.from_request(request)
+        request.cart = SimpleLazyObject(
+            lambda: cart.UserCart(request.user)
+            if request.user.is_authenticated else request.anonymous_cart
+        )
+        response = self.get_response(request)
+        request.anonymous_cart.save(response)
+        return response
+
+
+class QueryCountMiddleware:
+    """Добавляет к ответу заголовок X-DB-Queries с числом запросов к базе
+    при обработке запроса, включая запросы остальных middleware и шаблонов.
+    Включается настройкой QUERY_COUNT_HEADER."""
+
+    def __init__(self, get_response):
+        if not settings.QUERY_COUNT_HEADER:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = 0
+
+        def count(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count):
+            response = self.get_response(request)
+        response['X-DB-Queries'] = str(queries)
+        return response
+
+
+class MetricsMiddleware:
+    """Записывает метрики запроса для Prometheus (core/metrics.py): время
+    ответа, число и время запросов к базе, время шаблонов и Stripe.
+    Включается настройкой METRICS_ENABLED."""
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = metrics.start_request()
+        started = time.perf_counter()
+        try:
+            with connection.execute_wrapper(stats.time_query):
+                response = self.get_response(request)
+        finally:
+            metrics.finish_request()
+        metrics.observe_request(request, response, time.perf_counter() - started, stats)
+        return response
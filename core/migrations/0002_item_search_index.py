@@ -0,0 +1,37 @@
+from django.db import migrations
+
+from core.search import rebuild_index
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute('ALTER TABLE core_item ADD COLUMN search_vector tsvector')
+        schema_editor.execute(
+            'CREATE INDEX core_item_search_vector_idx ON core_item USING gin (search_vector)')
+    elif vendor == 'sqlite':
+        schema_editor.execute(
+            'CREATE VIRTUAL TABLE core_item_fts USING fts5('
+            "title, description, tokenize = 'unicode61 remove_diacritics 2')"
+        )
+    rebuild_index(schema_editor)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS core_item_search_vector_idx')
+        schema_editor.execute('ALTER TABLE core_item DROP COLUMN IF EXISTS search_vector')
+    elif vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS core_item_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
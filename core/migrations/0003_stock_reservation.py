@@ -0,0 +1,56 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_stock_shards(apps, schema_editor):
+    Item = apps.get_model('core', 'Item')
+    StockShard = apps.get_model('core', 'StockShard')
+    shards_count = settings.STOCK_SHARDS
+    shards = []
+    for item_id, quantity in Item.objects.values_list('id', 'quantity').iterator():
+        base, extra = divmod(max(quantity, 0), shards_count)
+        shards.extend(
+            StockShard(item_id=item_id, number=number, available=base + (number < extra))
+            for number in range(shards_count)
+        )
+    StockShard.objects.bulk_create(shards, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0002_item_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveSmallIntegerField(verbose_name='Номер части')),
+                ('available', models.IntegerField(default=0, verbose_name='Свободно')),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_shards', to='core.Item', verbose_name='Товар')),
+            ],
+            options={
+                'unique_together': {('item', 'number')},
+            },
+        ),
+        migrations.CreateModel(
+            name='StockHold',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField(verbose_name='Номер части')),
+                ('quantity', models.PositiveIntegerField(verbose_name='Количество')),
+                ('expires_at', models.DateTimeField(db_index=True, verbose_name='Действует до')),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.Item', verbose_name='Товар')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='stockhold',
+            index=models.Index(fields=['user', 'item'], name='core_stockhold_user_item_idx'),
+        ),
+        migrations.RunPython(create_stock_shards, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_stock_reservation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='discount_price',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=9, null=True, verbose_name='Скидочная цена'),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='price',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=9, null=True, verbose_name='Цена'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0004_orderitem_price_snapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('idempotency_key', models.CharField(max_length=64, unique=True, verbose_name='Ключ идемпотентности')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=9, verbose_name='Сумма')),
+                ('token', models.CharField(blank=True, max_length=255, verbose_name='Токен')),
+                ('customer', models.CharField(blank=True, max_length=50, verbose_name='Stripe ID покупателя')),
+                ('status', models.CharField(choices=[('P', 'Pending'), ('R', 'Running'), ('S', 'Succeeded'), ('F', 'Failed')], db_index=True, default='P', max_length=1, verbose_name='Статус')),
+                ('claim', models.CharField(blank=True, db_index=True, max_length=32, verbose_name='Метка воркера')),
+                ('error', models.TextField(blank=True, verbose_name='Ошибка')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создана')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Изменена')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.Order', verbose_name='Заказ')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+        ),
+    ]
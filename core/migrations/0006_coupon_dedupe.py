@@ -0,0 +1,29 @@
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def merge_duplicate_coupons(apps, schema_editor):
+    """Оставляет по одному промокоду на код: заказы переводятся
+    на самый старый из дублей, остальные удаляются."""
+    Coupon = apps.get_model('core', 'Coupon')
+    Order = apps.get_model('core', 'Order')
+    duplicates = (
+        Coupon.objects.values('code')
+        .annotate(kept=Min('id'), total=Count('id'))
+        .filter(total__gt=1)
+    )
+    for duplicate in duplicates:
+        extra = Coupon.objects.filter(code=duplicate['code']).exclude(id=duplicate['kept'])
+        Order.objects.filter(coupon__in=extra).update(coupon_id=duplicate['kept'])
+        extra.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_paymentjob'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_coupons, migrations.RunPython.noop),
+    ]
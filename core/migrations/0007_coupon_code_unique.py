@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_coupon_dedupe'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='coupon',
+            name='code',
+            field=models.CharField(max_length=15, unique=True, verbose_name='Код'),
+        ),
+    ]
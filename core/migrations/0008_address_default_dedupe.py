@@ -0,0 +1,29 @@
+from django.db import migrations
+from django.db.models import Count, Max
+
+
+def keep_latest_default(apps, schema_editor):
+    """Оставляет отметку по умолчанию только у последнего
+    адреса каждого типа у пользователя."""
+    Address = apps.get_model('core', 'Address')
+    duplicates = (
+        Address.objects.filter(default=True)
+        .values('user_id', 'address_type')
+        .annotate(kept=Max('id'), total=Count('id'))
+        .filter(total__gt=1)
+    )
+    for duplicate in duplicates:
+        Address.objects.filter(
+            user_id=duplicate['user_id'], address_type=duplicate['address_type'], default=True
+        ).exclude(id=duplicate['kept']).update(default=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_coupon_code_unique'),
+    ]
+
+    operations = [
+        migrations.RunPython(keep_latest_default, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_address_default_dedupe'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='address',
+            constraint=models.UniqueConstraint(condition=models.Q(default=True), fields=('user', 'address_type'), name='core_address_one_default_per_type'),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_item_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='image_hash',
+            field=models.CharField(blank=True, editable=False, max_length=16, verbose_name='Хэш копий изображения'),
+        ),
+    ]
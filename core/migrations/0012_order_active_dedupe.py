@@ -0,0 +1,69 @@
+from django.db import migrations
+from django.db.models import Count, Max
+
+
+def merge_active_orders(apps, schema_editor):
+    """Оставляет у пользователя одну активную корзину - последнюю.
+    Позиции остальных активных корзин сливаются с ней по товарам:
+    у товара остается одна позиция с суммой количеств, лишние позиции
+    и корзины удаляются. Позиция, которая связана еще и с другим
+    заказом, не меняется и не удаляется, а только отвязывается от
+    корзины. Итоги заказов считает миграция 0018."""
+    Order = apps.get_model('core', 'Order')
+    OrderItem = apps.get_model('core', 'OrderItem')
+    Through = Order.items.through
+    duplicates = (
+        Order.objects.filter(ordered=False)
+        .values('user_id')
+        .annotate(kept=Max('id'), total=Count('id'))
+        .filter(total__gt=1)
+    )
+    for duplicate in duplicates:
+        kept = duplicate['kept']
+        active = list(Order.objects.filter(
+            user_id=duplicate['user_id'], ordered=False).values_list('id', flat=True))
+        links = list(Through.objects.filter(order_id__in=active).values_list(
+            'order_id', 'orderitem_id', 'orderitem__item_id', 'orderitem__quantity'))
+        kept_lines = {orderitem_id for order_id, orderitem_id, _, _ in links if order_id == kept}
+        # {id товара: {id позиции: количество}}, общая позиция учитывается один раз.
+        lines = {}
+        for _, orderitem_id, item_id, quantity in links:
+            lines.setdefault(item_id, {})[orderitem_id] = quantity
+        all_lines = {orderitem_id for quantities in lines.values() for orderitem_id in quantities}
+        shared = set(
+            Through.objects.filter(orderitem_id__in=all_lines)
+            .exclude(order_id__in=active).values_list('orderitem_id', flat=True)
+        )
+
+        survivors = set()
+        for item_id, quantities in lines.items():
+            own = [orderitem_id for orderitem_id in quantities if orderitem_id not in shared]
+            if own:
+                survivor = min(own, key=lambda orderitem_id: (orderitem_id not in kept_lines, orderitem_id))
+            else:
+                # Все позиции товара принадлежат и другим заказам: корзине нужна своя.
+                line = OrderItem.objects.get(pk=min(quantities))
+                line.pk = None
+                line.ordered = False
+                line.save()
+                survivor = line.pk
+            OrderItem.objects.filter(pk=survivor).update(quantity=sum(quantities.values()))
+            if survivor not in kept_lines:
+                Through.objects.create(order_id=kept, orderitem_id=survivor)
+            survivors.add(survivor)
+
+        Through.objects.filter(order_id__in=active).exclude(
+            order_id=kept, orderitem_id__in=survivors).delete()
+        OrderItem.objects.filter(pk__in=all_lines - survivors - shared).delete()
+        Order.objects.filter(id__in=active).exclude(id=kept).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_item_image_hash'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_active_orders, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0012_order_active_dedupe'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(condition=models.Q(ordered=False), fields=('user',), name='core_order_one_active_per_user'),
+        ),
+        migrations.AddIndex(
+            model_name='orderitem',
+            index=models.Index(condition=models.Q(ordered=False), fields=['user', 'item'], name='core_orderitem_active_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_order_hot_path_indexes'),
+    ]
+
+    operations = [
+        # Временно без обратной связи: имя items пока занято Order.items.
+        migrations.AddField(
+            model_name='orderitem',
+            name='order',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.Order', verbose_name='Заказ'),
+        ),
+    ]
@@ -0,0 +1,75 @@
+from django.db import migrations, transaction
+
+
+BATCH_SIZE = 1000
+
+
+def copy_order_links(apps, schema_editor):
+    """Переносит связи заказ - позиция из таблицы Order.items в
+    OrderItem.order пачками по BATCH_SIZE строк. Позиция, связанная
+    с несколькими заказами (прежний код переиспользовал неоплаченные
+    позиции), копируется: у каждого заказа остается своя строка.
+    Перенесенные связи удаляются в той же транзакции, что и пачка,
+    поэтому после сбоя перенос продолжится с места остановки. Позиции
+    без заказа недоступны ни одной странице и удаляются, позиции
+    оплаченных заказов помечаются подтвержденными. Итоги заказов
+    считает миграция 0018."""
+    Order = apps.get_model('core', 'Order')
+    OrderItem = apps.get_model('core', 'OrderItem')
+    Through = Order.items.through
+    while True:
+        links = list(
+            Through.objects.order_by('id').values_list('id', 'order_id', 'orderitem_id')[:BATCH_SIZE])
+        if not links:
+            break
+        lines = OrderItem.objects.in_bulk({orderitem_id for _, _, orderitem_id in links})
+        moved, copies = [], []
+        for _, order_id, orderitem_id in links:
+            line = lines[orderitem_id]
+            if line.order_id == order_id:
+                # Связь уже перенесена, например до отката миграции.
+                continue
+            if line.order_id is None:
+                line.order_id = order_id
+                moved.append(line)
+            else:
+                copies.append(OrderItem(
+                    order_id=order_id, user_id=line.user_id, item_id=line.item_id,
+                    quantity=line.quantity, ordered=line.ordered,
+                    price=line.price, discount_price=line.discount_price,
+                ))
+        with transaction.atomic():
+            OrderItem.objects.bulk_update(moved, ['order'])
+            OrderItem.objects.bulk_create(copies)
+            Through.objects.filter(id__in=[link_id for link_id, _, _ in links]).delete()
+    OrderItem.objects.filter(order__isnull=True).delete()
+    OrderItem.objects.filter(order__ordered=True).update(ordered=True)
+
+
+def copy_order_links_back(apps, schema_editor):
+    Order = apps.get_model('core', 'Order')
+    OrderItem = apps.get_model('core', 'OrderItem')
+    Through = Order.items.through
+    last_id = 0
+    while True:
+        lines = list(
+            OrderItem.objects.filter(id__gt=last_id, order__isnull=False)
+            .order_by('id').values_list('id', 'order_id')[:BATCH_SIZE]
+        )
+        if not lines:
+            break
+        Through.objects.bulk_create(
+            [Through(order_id=order_id, orderitem_id=orderitem_id) for orderitem_id, order_id in lines])
+        last_id = lines[-1][0]
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('core', '0014_orderitem_order'),
+    ]
+
+    operations = [
+        migrations.RunPython(copy_order_links, copy_order_links_back),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_orderitem_order_data'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='order',
+            name='items',
+        ),
+        migrations.AlterField(
+            model_name='orderitem',
+            name='order',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='core.Order', verbose_name='Заказ'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0016_remove_order_items'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='discount',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12, verbose_name='Скидка'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='subtotal',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12, verbose_name='Сумма'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='total',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12, verbose_name='Итого'),
+        ),
+    ]
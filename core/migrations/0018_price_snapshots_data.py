@@ -0,0 +1,53 @@
+from decimal import Decimal
+
+from django.db import migrations, transaction
+from django.db.models import OuterRef, Subquery
+
+
+BATCH_SIZE = 500
+
+
+def snapshot_prices(apps, schema_editor):
+    """Фиксирует в позициях неоплаченных корзин текущие цены товаров
+    и считает итоги всех заказов пачками по BATCH_SIZE заказов."""
+    Item = apps.get_model('core', 'Item')
+    Order = apps.get_model('core', 'Order')
+    OrderItem = apps.get_model('core', 'OrderItem')
+
+    items = Item.objects.filter(pk=OuterRef('item_id'))
+    OrderItem.objects.filter(price__isnull=True).update(
+        price=Subquery(items.values('price')[:1]),
+        discount_price=Subquery(items.values('discount_price')[:1]),
+    )
+
+    last_id = 0
+    while True:
+        orders = list(
+            Order.objects.filter(id__gt=last_id).select_related('coupon').order_by('id')[:BATCH_SIZE])
+        if not orders:
+            break
+        totals = {order.id: [Decimal(0), Decimal(0)] for order in orders}
+        lines = OrderItem.objects.filter(order_id__in=totals).values_list(
+            'order_id', 'quantity', 'price', 'discount_price')
+        for order_id, quantity, price, discount_price in lines:
+            totals[order_id][0] += quantity * price
+            if discount_price:
+                totals[order_id][1] += quantity * (price - discount_price)
+        for order in orders:
+            order.subtotal, order.discount = totals[order.id]
+            order.total = order.subtotal - order.discount - (order.coupon.amount if order.coupon else 0)
+        with transaction.atomic():
+            Order.objects.bulk_update(orders, ['subtotal', 'discount', 'total'])
+        last_id = orders[-1].id
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('core', '0017_order_totals'),
+    ]
+
+    operations = [
+        migrations.RunPython(snapshot_prices, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0018_price_snapshots_data'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='orderitem',
+            name='price',
+            field=models.DecimalField(decimal_places=2, max_digits=9, verbose_name='Цена'),
+        ),
+    ]
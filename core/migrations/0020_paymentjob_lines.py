@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0019_orderitem_price_required'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paymentjob',
+            name='lines',
+            field=models.TextField(blank=True, verbose_name='Позиции'),
+        ),
+    ]
@@ -0,0 +1,56 @@
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_active_lines(apps, schema_editor):
+    """Сливает позиции одного товара в активной корзине: остается первая
+    позиция с суммой количеств, остальные удаляются. Итоги затронутых
+    заказов пересчитываются по позициям, как в миграции 0018."""
+    Order = apps.get_model('core', 'Order')
+    OrderItem = apps.get_model('core', 'OrderItem')
+    duplicates = (
+        OrderItem.objects.filter(ordered=False)
+        .values('user_id', 'item_id')
+        .annotate(kept=Min('id'), quantity=Sum('quantity'), total=Count('id'))
+        .filter(total__gt=1)
+    )
+    orders = set()
+    for duplicate in duplicates:
+        lines = OrderItem.objects.filter(
+            user_id=duplicate['user_id'], item_id=duplicate['item_id'], ordered=False)
+        orders.update(lines.values_list('order_id', flat=True))
+        OrderItem.objects.filter(pk=duplicate['kept']).update(quantity=duplicate['quantity'])
+        lines.exclude(pk=duplicate['kept']).delete()
+
+    for order in Order.objects.filter(pk__in=orders).select_related('coupon'):
+        order.subtotal = order.discount = Decimal(0)
+        for quantity, price, discount_price in OrderItem.objects.filter(
+                order_id=order.pk).values_list('quantity', 'price', 'discount_price'):
+            order.subtotal += quantity * price
+            if discount_price:
+                order.discount += quantity * (price - discount_price)
+        order.total = order.subtotal - order.discount - (order.coupon.amount if order.coupon else 0)
+        order.save(update_fields=['subtotal', 'discount', 'total'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0020_paymentjob_lines'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='orderitem',
+            name='core_orderitem_active_idx',
+        ),
+        migrations.RunPython(merge_active_lines, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='orderitem',
+            constraint=models.UniqueConstraint(condition=models.Q(ordered=False), fields=('user', 'item'), name='core_orderitem_one_active_per_item'),
+        ),
+    ]
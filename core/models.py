@@ -8,14 +8,18 @@
 5. Подтверждает оплату.
 6. Заказ отслеживается до момента доставки. Пользователь может оформить возврат.
 """
-from django.db.models.signals import post_save
-from django.utils import timezone
+import json
+
+from django.db.models.signals import post_save, post_delete
 from django.conf import settings
-from django.contrib import messages
-from django.db import models
+from django.db import models, transaction
 from django.urls import reverse
 from django_countries.fields import CountryField
 
+from core import addresses, images, proxy_cache, search
+from core.cache import bump_version
+from core.query_budget import query_budget
+
 
 # Приоритет товара, влияет на отображение названия товара на странице.
 LABEL_CHOICES = (
@@ -24,6 +28,21 @@ LABEL_CHOICES = (
     ('Скидка', 'danger'),
 )
 
+# Тип денежных значений, вычисляемых в запросах.
+PRICE_FIELD = models.DecimalField(max_digits=12, decimal_places=2)
+
+# Статусы задачи на оплату
+PAYMENT_JOB_PENDING = 'P'
+PAYMENT_JOB_RUNNING = 'R'
+PAYMENT_JOB_SUCCEEDED = 'S'
+PAYMENT_JOB_FAILED = 'F'
+PAYMENT_JOB_STATUS_CHOICES = (
+    (PAYMENT_JOB_PENDING, 'Pending'),
+    (PAYMENT_JOB_RUNNING, 'Running'),
+    (PAYMENT_JOB_SUCCEEDED, 'Succeeded'),
+    (PAYMENT_JOB_FAILED, 'Failed'),
+)
+
 # Категории адресов пользователя
 ADDRESS_CHOICES = (
     ('B', 'Billing'),
@@ -51,6 +70,9 @@ class Item(models.Model):
     description = models.TextField('Описание')
     quantity = models.IntegerField(default=1, verbose_name='Количество')
     image = models.ImageField('Изображение')
+    updated_at = models.DateTimeField('Изменен', auto_now=True, db_index=True)
+    # Хэш уменьшенных копий изображения, см. core/images.py.
+    image_hash = models.CharField('Хэш копий изображения', max_length=16, blank=True, editable=False)
 
     class Meta:
         ordering = ['-id']
@@ -67,93 +89,72 @@ class Item(models.Model):
     def get_remove_from_cart_url(self):
         return reverse('core:remove-from-cart', kwargs={'slug': self.slug})
 
-    def add_item_to_cart(self, request):
-        """Добавляем товар в корзину."""
-        order_item, created = OrderItem.objects.get_or_create(
-            item=self,
-            user=request.user,
-            ordered=False
-        )
 
-        order_qs = Order.objects.filter(user=request.user, ordered=False)
-        if order_qs.exists():
-            order = order_qs[0]
-            # Проверяем, есть ли товар в корзине
-            if order.items.filter(item__slug=self.slug).exists():
-                order_item.quantity += 1
-                order_item.save()
-                return messages.info(request, 'Количество товара в корзине было изменено.')
-            else:
-                order.items.add(order_item)
-                return messages.info(request, 'Товар был добавлен в вашу корзину.')
-        else:
-            # Если заказа еще не существует, то создаем его
-            ordered_date = timezone.now()
-            order = Order.objects.create(user=request.user, ordered_date=ordered_date)
-            order.items.add(order_item)
-            return messages.info(request, 'Товар был добавлен в вашу корзину.')
-
-    def remove_item_from_cart(self, request):
-        """Удаляем товар из корзины."""
-        order_qs = Order.objects.filter(user=request.user, ordered=False)
-        if order_qs.exists():
-            order = order_qs[0]
-            # Проверяем, есть ли товар в корзине
-            if order.items.filter(item__slug=self.slug).exists():
-                order_item = OrderItem.objects.filter(
-                    item=self,
-                    user=request.user,
-                    ordered=False
-                )[0]
-                order.items.remove(order_item)
-                order_item.delete()
-                return messages.info(request, 'Товар был удален из вашей корзины.')
-            else:
-                return messages.info(request, 'Этого товара нет в вашей корзине.')
-        return messages.info(request, 'У вас активной корзины. Для начала добавьте товар.')
-
-    def remove_single_item_from_cart(self, request):
-        """Удаляем один экземпляр товара из корзины."""
-        order_qs = Order.objects.filter(user=request.user, ordered=False)
-        if order_qs.exists():
-            order = order_qs[0]
-            if order.items.filter(item__slug=self.slug).exists():
-                order_item = OrderItem.objects.filter(
-                    item=self,
-                    user=request.user,
-                    ordered=False
-                )[0]
-                if order_item.quantity > 1:
-                    order_item.quantity -= 1
-                    order_item.save()
-                else:
-                    # Если товар в корзине последний.
-                    order.items.remove(order_item)
-                    return messages.info(request, 'Количество товара в корзине было изменено.')
-            else:
-                return messages.info(request, 'Этого товара нет в вашей корзине.')
-        else:
-            return messages.info(request, 'У вас активной корзины. Для начала добавьте товар.')
+class OrderItemQuerySet(models.QuerySet):
+
+    def with_prices(self):
+        """Добавляет к позициям цену за единицу с учетом скидки (unit_price),
+        итоговую стоимость (line_total) и сумму скидки (line_saved)
+        по ценам, зафиксированным в позиции."""
+        has_discount = models.Q(discount_price__gt=0)
+        return self.annotate(
+            unit_price=models.Case(
+                models.When(has_discount, then=models.F('discount_price')),
+                default=models.F('price'),
+                output_field=PRICE_FIELD,
+            ),
+            unit_saved=models.Case(
+                models.When(has_discount, then=models.F('price') - models.F('discount_price')),
+                default=models.Value(0),
+                output_field=PRICE_FIELD,
+            ),
+        ).annotate(
+            line_total=models.ExpressionWrapper(
+                models.F('quantity') * models.F('unit_price'), output_field=PRICE_FIELD),
+            line_saved=models.ExpressionWrapper(
+                models.F('quantity') * models.F('unit_saved'), output_field=PRICE_FIELD),
+        )
 
 
 class OrderItem(models.Model):
-    """Модель одной позиции товара в корзине пользователя."""
+    """Модель одной позиции товара в корзине пользователя.
+    user и ordered повторяют поля заказа, чтобы позиции активной корзины
+    выбирались без соединения с заказом (индекс core_orderitem_one_active_per_item)."""
+    order = models.ForeignKey(
+        'Order', related_name='items', on_delete=models.CASCADE, verbose_name='Заказ')
     user = models.ForeignKey(settings.AUTH_USER_MODEL,
                              on_delete=models.CASCADE, verbose_name='Пользователь')
     ordered = models.BooleanField(default=False, verbose_name='Заказ подтвержден')
     item = models.ForeignKey(Item, on_delete=models.CASCADE, verbose_name='Товар')
     quantity = models.IntegerField(default=1, verbose_name='Количество')
+    # Цены товара на момент добавления в корзину, изменение цен
+    # в каталоге не меняет корзину и подтвержденные заказы.
+    price = models.DecimalField(max_digits=9, decimal_places=2, verbose_name='Цена')
+    discount_price = models.DecimalField(
+        max_digits=9, decimal_places=2, blank=True, null=True, verbose_name='Скидочная цена')
+
+    objects = OrderItemQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            # Не больше одной позиции товара в активной корзине, индекс
+            # используется и для поиска позиции по user, item, ordered=False.
+            models.UniqueConstraint(
+                fields=['user', 'item'], condition=models.Q(ordered=False),
+                name='core_orderitem_one_active_per_item'
+            ),
+        ]
 
     def __str__(self):
         return f'{self.quantity} of {self.item.title}'
 
     def get_total_item_price(self):
         """Цена одной позиции товара, с учетом его количества."""
-        return self.quantity * self.item.price
+        return self.quantity * self.price
 
     def get_total_discount_price(self):
         """Скидочная цена одной позиции товара, с учетом его стоимости."""
-        return self.quantity * self.item.discount_price
+        return self.quantity * self.discount_price
 
     def get_amount_saved(self):
         """Разница регулярной цены и скидочной."""
@@ -161,7 +162,7 @@ class OrderItem(models.Model):
 
     def get_final_price(self):
         """Итоговая стоимость одной позиции в корзине."""
-        if self.item.discount_price:
+        if self.discount_price:
             return self.get_total_discount_price()
         return self.get_total_item_price()
 
@@ -174,7 +175,6 @@ class Order(models.Model):
         max_length=20, blank=True, unique=True,
         null=True, verbose_name='Уникальный ключ'
     )       # TODO verbose name
-    items = models.ManyToManyField(OrderItem, verbose_name='Товары')
     start_date = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
     ordered_date = models.DateTimeField(verbose_name='Дата подтверждения')
     ordered = models.BooleanField(default=False, verbose_name='Заказ подтвержден')
@@ -194,25 +194,29 @@ class Order(models.Model):
     received = models.BooleanField(default=False, verbose_name='Получено')
     refund_requested = models.BooleanField(default=False, verbose_name='Запрошен возврат')
     refund_granted = models.BooleanField(default=False, verbose_name='Возврат предоставлен')
+    # Итоги по ценам позиций: сумма без скидок, скидка на товары и сумма
+    # к оплате с учетом промокода. Меняются вместе с корзиной (core/cart.py).
+    subtotal = models.DecimalField(max_digits=12, decimal_places=2, default=0, verbose_name='Сумма')
+    discount = models.DecimalField(max_digits=12, decimal_places=2, default=0, verbose_name='Скидка')
+    total = models.DecimalField(max_digits=12, decimal_places=2, default=0, verbose_name='Итого')
+
+    class Meta:
+        constraints = [
+            # Не больше одной активной корзины у пользователя, индекс
+            # используется и для поиска корзины по user, ordered=False.
+            models.UniqueConstraint(
+                fields=['user'], condition=models.Q(ordered=False),
+                name='core_order_one_active_per_user'
+            ),
+        ]
 
     def __str__(self):
         return self.user.username
 
+    @query_budget(queries=0)
     def get_total(self):
         """Возвращает итоговую стоимость корзины с учетом промокода."""
-        total = 0
-        for order_item in self.items.all():
-            total += order_item.get_final_price()
-        if self.coupon:
-            total -= self.coupon.amount
-        return total
-
-    def confirm_order_items(self):
-        """Подтверждает все позиции в корзине."""
-        order_items = self.items.all()
-        order_items.update(ordered=True)
-        for item in order_items:
-            item.save()
+        return self.total
 
 
 class Address(models.Model):
@@ -233,6 +237,13 @@ class Address(models.Model):
 
     class Meta:
         verbose_name_plural = 'Addresses'
+        constraints = [
+            # Не больше одного адреса по умолчанию каждого типа.
+            models.UniqueConstraint(
+                fields=['user', 'address_type'], condition=models.Q(default=True),
+                name='core_address_one_default_per_type'
+            ),
+        ]
 
 
 class Payment(models.Model):
@@ -249,9 +260,42 @@ class Payment(models.Model):
         return self.user.username
 
 
+class PaymentJob(models.Model):
+    """Задача на оплату заказа, которую выполняет воркер run_payment_worker.
+    Ключ идемпотентности передается в Stripe, поэтому повторное выполнение
+    задачи не списывает деньги дважды."""
+    idempotency_key = models.CharField('Ключ идемпотентности', max_length=64, unique=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             on_delete=models.CASCADE, verbose_name='Пользователь')
+    order = models.ForeignKey('Order', on_delete=models.CASCADE, verbose_name='Заказ')
+    amount = models.DecimalField(max_digits=9, decimal_places=2, verbose_name='Сумма')
+    # Оплачиваемые позиции в JSON: {id товара: количество}.
+    lines = models.TextField('Позиции', blank=True)
+    # Одноразовый токен карты, удаляется после выполнения задачи.
+    token = models.CharField('Токен', max_length=255, blank=True)
+    customer = models.CharField('Stripe ID покупателя', max_length=50, blank=True)
+    status = models.CharField(
+        'Статус', max_length=1, choices=PAYMENT_JOB_STATUS_CHOICES,
+        default=PAYMENT_JOB_PENDING, db_index=True
+    )
+    # Метка воркера, который взял задачу в работу.
+    claim = models.CharField('Метка воркера', max_length=32, blank=True, db_index=True)
+    error = models.TextField('Ошибка', blank=True)
+    created_at = models.DateTimeField('Создана', auto_now_add=True)
+    updated_at = models.DateTimeField('Изменена', auto_now=True)
+
+    def __str__(self):
+        return self.idempotency_key
+
+    def get_lines(self):
+        """Оплачиваемые позиции {id товара: количество}."""
+        return {int(item_id): quantity
+                for item_id, quantity in json.loads(self.lines or '{}').items()}
+
+
 class Coupon(models.Model):
     """Модель скидочного промокода"""
-    code = models.CharField(max_length=15, verbose_name='Код')
+    code = models.CharField(max_length=15, unique=True, verbose_name='Код')
     amount = models.DecimalField(max_digits=9, decimal_places=2, verbose_name='Сумма скидки')
 
     def __str__(self):
@@ -285,6 +329,65 @@ class UserProfile(models.Model):
         return self.user.username
 
 
+class StockShard(models.Model):
+    """Часть свободного остатка товара. Остаток разбит на STOCK_SHARDS строк,
+    чтобы параллельные покупатели одного товара не ждали блокировку одной строки."""
+    item = models.ForeignKey(
+        Item, on_delete=models.CASCADE, related_name='stock_shards', verbose_name='Товар')
+    number = models.PositiveSmallIntegerField('Номер части')
+    available = models.IntegerField('Свободно', default=0)
+
+    class Meta:
+        unique_together = ('item', 'number')
+
+    def __str__(self):
+        return f'{self.item_id}#{self.number}: {self.available}'
+
+    @classmethod
+    def rebalance(cls, item):
+        """Распределяет свободный остаток товара (количество за вычетом
+        резервов) поровну между частями. Лишние части удаляются,
+        их резервы переносятся в оставшиеся."""
+        shards_count = settings.STOCK_SHARDS
+        with transaction.atomic():
+            # Блокируем части, чтобы резервы не менялись во время пересчета.
+            list(cls.objects.select_for_update().filter(item=item))
+            held = StockHold.objects.filter(item=item).aggregate(
+                held=models.Sum('quantity'))['held'] or 0
+            free = max(item.quantity - held, 0)
+            base, extra = divmod(free, shards_count)
+            # Резервы из удаляемых частей переносим в оставшиеся, иначе при снятии
+            # резерва единицы вернулись бы в несуществующую часть и пропали.
+            StockHold.objects.filter(item=item, shard__gte=shards_count).update(
+                shard=models.F('shard') % shards_count)
+            cls.objects.filter(item=item, number__gte=shards_count).delete()
+            for number in range(shards_count):
+                cls.objects.update_or_create(
+                    item=item, number=number,
+                    defaults={'available': base + (number < extra)}
+                )
+
+
+class StockHold(models.Model):
+    """Временный резерв товара для корзины пользователя. Зарезервированные
+    единицы уже вычтены из частей остатка, при оплате резерв списывается
+    с Item.quantity, а просроченные резервы возвращаются в остаток."""
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             on_delete=models.CASCADE, verbose_name='Пользователь')
+    item = models.ForeignKey(Item, on_delete=models.CASCADE, verbose_name='Товар')
+    shard = models.PositiveSmallIntegerField('Номер части')
+    quantity = models.PositiveIntegerField('Количество')
+    expires_at = models.DateTimeField('Действует до', db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'item'], name='core_stockhold_user_item_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.quantity} of {self.item_id} for {self.user_id}'
+
+
 def userprofile_receiver(sender, instance, created, *args, **kwargs):
     """Привязываем нашу модель UserProfile с моделью User при входящем
     сигнале о новом пользователе."""
@@ -293,3 +396,89 @@ def userprofile_receiver(sender, instance, created, *args, **kwargs):
 
 
 post_save.connect(userprofile_receiver, sender=settings.AUTH_USER_MODEL)
+
+
+def category_cache_receiver(sender, *args, **kwargs):
+    """Сбрасываем кэш категорий и меню каталога при изменении категории."""
+    bump_version('categories')
+
+
+post_save.connect(category_cache_receiver, sender=Category)
+post_delete.connect(category_cache_receiver, sender=Category)
+
+
+def coupon_cache_receiver(sender, *args, **kwargs):
+    """Сбрасывает кэш промокодов, включая закэшированные ненайденные коды."""
+    bump_version('coupons')
+
+
+post_save.connect(coupon_cache_receiver, sender=Coupon)
+post_delete.connect(coupon_cache_receiver, sender=Coupon)
+
+
+def address_cache_receiver(sender, instance, *args, **kwargs):
+    """Сбрасывает кэш адресов по умолчанию пользователя."""
+    transaction.on_commit(lambda: addresses.invalidate_default_addresses(instance.user_id))
+
+
+post_save.connect(address_cache_receiver, sender=Address)
+post_delete.connect(address_cache_receiver, sender=Address)
+
+
+def item_search_index_receiver(sender, instance, *args, **kwargs):
+    """Обновляем поисковый индекс при сохранении товара."""
+    search.index_item(instance)
+
+
+def item_search_unindex_receiver(sender, instance, *args, **kwargs):
+    """Удаляем товар из поискового индекса."""
+    search.unindex_item(instance)
+
+
+post_save.connect(item_search_index_receiver, sender=Item)
+post_delete.connect(item_search_unindex_receiver, sender=Item)
+
+
+def item_stock_receiver(sender, instance, *args, **kwargs):
+    """Пересчитываем части остатка при изменении товара."""
+    StockShard.rebalance(instance)
+
+
+post_save.connect(item_stock_receiver, sender=Item)
+
+
+def catalog_cache_receiver(sender, *args, **kwargs):
+    """Меняет версию каталога, от которой зависят ETag страниц со списком
+    товаров. Массовые update() сигналов не вызывают."""
+    bump_version('catalog')
+
+
+post_save.connect(catalog_cache_receiver, sender=Item)
+post_delete.connect(catalog_cache_receiver, sender=Item)
+
+
+def item_image_receiver(sender, instance, *args, **kwargs):
+    """Создает уменьшенные копии изображения товара. Копии создаются до
+    обновления страниц в кэше nginx, чтобы в них попал новый srcset."""
+    transaction.on_commit(lambda: images.update_item_variants(instance))
+
+
+post_save.connect(item_image_receiver, sender=Item)
+
+
+def item_proxy_cache_receiver(sender, instance, *args, **kwargs):
+    """Обновляет страницы товара в кэше nginx."""
+    paths = proxy_cache.item_paths(instance)
+    transaction.on_commit(lambda: proxy_cache.refresh_pages(paths))
+
+
+def category_proxy_cache_receiver(sender, instance, *args, **kwargs):
+    """Обновляет списки товаров категории в кэше nginx."""
+    paths = proxy_cache.category_paths(instance.pk)
+    transaction.on_commit(lambda: proxy_cache.refresh_pages(paths))
+
+
+post_save.connect(item_proxy_cache_receiver, sender=Item)
+post_delete.connect(item_proxy_cache_receiver, sender=Item)
+post_save.connect(category_proxy_cache_receiver, sender=Category)
+post_delete.connect(category_proxy_cache_receiver, sender=Category)
@@ -0,0 +1,120 @@
+"""
+Постраничный вывод товаров по курсору (keyset pagination).
+
+Вместо OFFSET страница строится от id последнего показанного товара:
+`WHERE id < курсор ORDER BY id DESC LIMIT n`. Такой запрос идет по первичному
+ключу, поэтому время ответа не зависит от номера страницы.
+"""
+from django.core import paginator
+
+
+class KeysetPage:
+    """Страница выборки с курсорами на соседние страницы."""
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def next_page_query(self):
+        return f'after={self.next_cursor}'
+
+    def previous_page_query(self):
+        return f'before={self.previous_cursor}'
+
+
+class KeysetPaginator:
+    """Разбивает выборку на страницы по убыванию id
+    (совпадает с Item.Meta.ordering)."""
+
+    def __init__(self, queryset, per_page):
+        self.queryset = queryset
+        self.per_page = per_page
+
+    def page(self, after=None, before=None):
+        """Возвращает страницу после курсора `after`
+        или перед курсором `before`."""
+        if before is not None:
+            return self._page_before(before)
+        return self._page_after(after)
+
+    def _page_after(self, cursor):
+        queryset = self.queryset
+        if cursor is not None:
+            queryset = queryset.filter(id__lt=cursor)
+        # Берем на одну запись больше, чтобы узнать, есть ли следующая страница.
+        objects = list(queryset.order_by('-id')[:self.per_page + 1])
+        has_next = len(objects) > self.per_page
+        objects = objects[:self.per_page]
+        return KeysetPage(
+            objects,
+            next_cursor=objects[-1].id if has_next else None,
+            previous_cursor=objects[0].id if cursor is not None and objects else None,
+        )
+
+    def _page_before(self, cursor):
+        objects = list(
+            self.queryset.filter(id__gt=cursor).order_by('id')[:self.per_page + 1])
+        has_previous = len(objects) > self.per_page
+        objects = objects[:self.per_page]
+        objects.reverse()
+        return KeysetPage(
+            objects,
+            next_cursor=objects[-1].id if objects else None,
+            previous_cursor=objects[0].id if has_previous else None,
+        )
+
+
+class Page(paginator.Page):
+    """Обычная страница с номером, для выборок, которые нельзя
+    разбить по курсору (например, результаты поиска по релевантности)."""
+
+    def next_page_query(self):
+        return f'page={self.next_page_number()}'
+
+    def previous_page_query(self):
+        return f'page={self.previous_page_number()}'
+
+
+class Paginator(paginator.Paginator):
+    """Paginator, который возвращает страницы класса Page."""
+
+    def _get_page(self, *args, **kwargs):
+        return Page(*args, **kwargs)
+
+
+def parse_cursor(value):
+    """Курсор из GET-параметра, некорректное значение означает первую страницу."""
+    try:
+        cursor = int(value)
+    except (TypeError, ValueError):
+        return None
+    return cursor if cursor > 0 else None
+
+
+class KeysetPaginationMixin:
+    """Подменяет постраничный вывод ListView на вывод по курсору.
+    Курсоры передаются в GET-параметрах `after` и `before`."""
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = KeysetPaginator(queryset, page_size)
+        page = paginator.page(
+            after=parse_cursor(self.request.GET.get('after')),
+            before=parse_cursor(self.request.GET.get('before')),
+        )
+        return paginator, page, page.object_list, page.has_other_pages()
@@ -0,0 +1,149 @@
+"""
+Асинхронная оплата заказов.
+
+При PAYMENT_ASYNC = True PaymentView.post не обращается к Stripe сам,
+а создает задачу PaymentJob и сразу показывает страницу ожидания. Задачи
+выполняет воркер (manage.py run_payment_worker) в пуле потоков, поэтому
+время ответа Stripe больше не занимает воркеры gunicorn. Ключ
+идемпотентности задачи передается в Stripe: если воркер упал посреди
+оплаты, задача выполнится повторно без повторного списания.
+
+Задача хранит сумму и позиции корзины, за которые берется оплата. Если
+корзина изменилась, пока задача ждала воркера, оплата не списывается;
+если она изменилась во время списания, заказ не подтверждается,
+а оплата возвращается.
+"""
+import json
+import logging
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import timedelta
+
+import stripe
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from core import cart
+from core.models import (
+    PaymentJob, PAYMENT_JOB_PENDING, PAYMENT_JOB_RUNNING,
+    PAYMENT_JOB_SUCCEEDED, PAYMENT_JOB_FAILED
+)
+from core.services import create_charge_or_error, refund_charge
+
+
+logger = logging.getLogger(__name__)
+
+# Через сколько задача в статусе Running считается брошенной упавшим воркером.
+STALE_JOB_TIMEOUT = timedelta(minutes=5)
+
+
+def enqueue_charge(order, user, amount, lines, token=None, customer=None):
+    """Ставит оплату заказа в очередь. lines - оплачиваемые позиции
+    {id товара: количество}. Невыполненная задача по заказу на ту же сумму
+    и те же позиции возвращается вместо новой. Задача для прежнего состава
+    корзины отменяется, если воркер ее еще не взял, иначе возвращается None."""
+    lines = json.dumps(lines, sort_keys=True)
+    with transaction.atomic():
+        # Сначала запись: отменяем ожидающие задачи для другого состава корзины.
+        PaymentJob.objects.filter(order=order, status=PAYMENT_JOB_PENDING).exclude(
+            amount=amount, lines=lines
+        ).update(status=PAYMENT_JOB_FAILED, token='', error=cart.CART_CHANGED,
+                 updated_at=timezone.now())
+        job = PaymentJob.objects.select_for_update().filter(
+            order=order, status__in=[PAYMENT_JOB_PENDING, PAYMENT_JOB_RUNNING]
+        ).first()
+        if job is None:
+            job = PaymentJob.objects.create(
+                idempotency_key=uuid.uuid4().hex,
+                user=user,
+                order=order,
+                amount=amount,
+                lines=lines,
+                token=token or '',
+                customer=customer or '',
+            )
+        elif job.amount != amount or job.lines != lines:
+            return None
+    return job
+
+
+def claim_jobs(limit):
+    """Забирает из очереди до limit задач и переводит их в статус Running.
+    Задачи помечаются одним условным UPDATE, поэтому параллельные воркеры
+    не возьмут одну задачу дважды, а транзакция сразу начинается с записи."""
+    stale = timezone.now() - STALE_JOB_TIMEOUT
+    waiting = Q(status=PAYMENT_JOB_PENDING) | Q(status=PAYMENT_JOB_RUNNING, updated_at__lt=stale)
+    claim = uuid.uuid4().hex
+    candidates = PaymentJob.objects.filter(waiting).order_by('id').values('pk')[:limit]
+    PaymentJob.objects.filter(waiting, pk__in=candidates).update(
+        status=PAYMENT_JOB_RUNNING, claim=claim, updated_at=timezone.now())
+    return list(PaymentJob.objects.select_related('order', 'user').filter(claim=claim))
+
+
+def _fail(job, error):
+    PaymentJob.objects.filter(pk=job.pk).update(
+        status=PAYMENT_JOB_FAILED, token='', error=error, updated_at=timezone.now())
+
+
+def process_job(job):
+    """Списывает оплату по задаче и подтверждает заказ
+    с позициями, за которые она списана."""
+    order, user = job.order, job.user
+    lines = job.get_lines()
+    try:
+        cart.check_order(order, job.amount, lines)
+    except cart.CartChanged:
+        _fail(job, cart.CART_CHANGED)
+        return
+
+    charge = create_charge_or_error(
+        amount=int(job.amount * 100),    # в центах
+        currency='usd',
+        token=job.token or None,
+        customer=job.customer or None,
+        idempotency_key=job.idempotency_key,
+    )
+    if not isinstance(charge, stripe.Charge):
+        _fail(job, charge)
+        return
+
+    try:
+        with transaction.atomic():
+            PaymentJob.objects.filter(pk=job.pk).update(
+                status=PAYMENT_JOB_SUCCEEDED, token='', updated_at=timezone.now())
+            cart.finalize_order(order, user, charge['id'], job.amount, lines)
+    except cart.CartChanged:
+        refunded = refund_charge(charge['id'], idempotency_key=f'refund-{job.idempotency_key}')
+        _fail(job, cart.CART_CHANGED_REFUNDED if refunded else cart.REFUND_FAILED)
+
+
+def _run(job):
+    try:
+        process_job(job)
+    except Exception:
+        # Задача останется в статусе Running и будет повторена
+        # после STALE_JOB_TIMEOUT с тем же ключом идемпотентности.
+        logger.exception('Payment job %s failed', job.idempotency_key)
+    finally:
+        connection.close()
+
+
+def run_worker(concurrency, poll_interval=1.0, once=False):
+    """Выполняет задачи из очереди, не больше concurrency одновременно.
+    Освободившиеся потоки сразу получают новые задачи. С once=True
+    воркер завершается, когда очередь опустеет."""
+    running = set()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='payment') as executor:
+        while True:
+            close_old_connections()
+            free = concurrency - len(running)
+            if free:
+                running |= {executor.submit(_run, job) for job in claim_jobs(free)}
+            if not running:
+                if once:
+                    return
+                time.sleep(poll_interval)
+                continue
+            _, running = wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
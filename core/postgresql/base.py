@@ -0,0 +1,38 @@
+"""
+Бэкенд postgres с проверкой постоянных соединений.
+
+С CONN_MAX_AGE > 0 соединение переживает запрос, но за время простоя его
+может закрыть postgres, pgbouncer или сеть. С CONN_HEALTH_CHECKS = True
+перед первым запросом к базе в каждом HTTP-запросе соединение проверяется
+(SELECT 1) и при ошибке открывается заново, вместо ошибки 500. Так же
+работает одноименная настройка Django 4.1+.
+"""
+from django.db.backends.postgresql import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    health_check_done = False
+
+    def connect(self):
+        super().connect()
+        # Только что открытое соединение проверять не нужно.
+        self.health_check_done = True
+
+    def close_if_unusable_or_obsolete(self):
+        # Вызывается в начале и в конце каждого запроса: следующее
+        # обращение к базе снова проверит соединение.
+        if self.connection is not None:
+            self.health_check_done = False
+        super().close_if_unusable_or_obsolete()
+
+    def close_if_health_check_failed(self):
+        if (self.connection is None or self.health_check_done
+                or not self.settings_dict.get('CONN_HEALTH_CHECKS')):
+            return
+        if not self.is_usable():
+            self.close()
+        self.health_check_done = True
+
+    def _cursor(self, name=None):
+        self.close_if_health_check_failed()
+        return super()._cursor(name)
@@ -0,0 +1,51 @@
+"""
+Обновление страниц в кэше nginx.
+
+nginx кэширует страницы каталога для анонимных посетителей на несколько
+секунд (см. nginx/nginx.conf). Чтобы изменения товаров и категорий были
+видны сразу, после фиксации транзакции приложение в фоне запрашивает
+затронутые страницы у nginx с заголовком X-Cache-Refresh: nginx идет за
+ними в приложение в обход кэша и сохраняет свежий ответ. Остальные страницы
+(следующие страницы списков, поиск) обновляются по истечении времени жизни.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from django.urls import reverse
+
+
+logger = logging.getLogger(__name__)
+
+refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='proxy-cache')
+
+
+def _refresh(path):
+    try:
+        requests.get(
+            settings.PROXY_CACHE_URL + path,
+            headers={
+                'Host': settings.PROXY_CACHE_HOST,
+                'X-Cache-Refresh': settings.CACHE_REFRESH_TOKEN,
+            },
+            timeout=10,
+        )
+    except requests.RequestException as e:
+        logger.warning('Proxy cache refresh of %s failed: %s', path, e)
+
+
+def refresh_pages(paths):
+    """Обновляет страницы в кэше nginx, если он настроен (PROXY_CACHE_URL)."""
+    if not settings.PROXY_CACHE_URL:
+        return
+    for path in dict.fromkeys(paths):
+        refresh_executor.submit(_refresh, path)
+
+
+def category_paths(category_id):
+    return [reverse('core:home'), reverse('core:products-by-category', kwargs={'id': category_id})]
+
+
+def item_paths(item):
+    return [*category_paths(item.category_id), item.get_absolute_url()]
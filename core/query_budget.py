@@ -0,0 +1,132 @@
+"""
+Бюджеты запросов к базе.
+
+Представления из core/urls.py и основные функции корзины объявляют
+декоратором query_budget, сколько запросов к базе им можно выполнить
+и сколько из них могут быть повторами - тем же SQL с другими параметрами,
+обычно это N+1. Декоратор только сохраняет бюджет в атрибуте query_budget
+функции или класса и не меняет их работу.
+
+Блок кода проверяет контекстный менеджер enforce_budget, все объявленные
+бюджеты - команда check_query_budgets: она выполняет представления
+на каталоге и корзине разного размера и проверяет, что число запросов
+от размера не зависит.
+"""
+import os
+import re
+import traceback
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+Budget = namedtuple('Budget', ('queries', 'duplicates'))
+CapturedQuery = namedtuple('CapturedQuery', ('sql', 'stack'))
+
+# Точки сохранения не считаются: внутри общей транзакции (как в команде
+# проверки) каждый atomic() становится точкой сохранения.
+SAVEPOINT_RE = re.compile(r'\s*(SAVEPOINT|RELEASE SAVEPOINT|ROLLBACK TO SAVEPOINT)\b', re.I)
+
+# Сколько стеков вызовов выводить для повторяющегося запроса.
+DUPLICATE_STACKS = 2
+
+
+class QueryBudgetExceeded(Exception):
+    """Код выполнил больше запросов или повторов, чем разрешает бюджет."""
+
+
+def query_budget(queries, duplicates=0):
+    """Объявляет бюджет функции, класса представления или его метода
+    (get, post): не больше queries запросов, из них не больше duplicates
+    повторов."""
+    def decorator(obj):
+        obj.query_budget = Budget(queries, duplicates)
+        return obj
+    return decorator
+
+
+def get_budget(view, method='GET'):
+    """Бюджет представления из urlpatterns для HTTP-метода или None.
+    Бюджет метода класса важнее бюджета самого класса."""
+    view_class = getattr(view, 'view_class', None)
+    if view_class is None:
+        return getattr(view, 'query_budget', None)
+    handler = getattr(view_class, method.lower(), None)
+    return getattr(handler, 'query_budget', None) or getattr(view_class, 'query_budget', None)
+
+
+def _stack():
+    """Вызовы из кода проекта, без Django, библиотек, команд manage.py
+    и этого модуля."""
+    here = os.path.abspath(__file__)
+    frames = [
+        frame for frame in traceback.extract_stack()
+        if frame.filename.startswith(settings.BASE_DIR)
+        and 'site-packages' not in frame.filename
+        and f'{os.sep}management{os.sep}' not in frame.filename
+        and os.path.basename(frame.filename) != 'manage.py'
+        and os.path.abspath(frame.filename) != here
+    ]
+    return ''.join(traceback.format_list(frames))
+
+
+class QueryLog:
+    """Запросы к базе, выполненные в блоке with, со стеками вызовов."""
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.connection = connections[using]
+        self.queries = []
+
+    def __enter__(self):
+        self._wrapper = self.connection.execute_wrapper(self._record)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._wrapper.__exit__(*exc_info)
+
+    def _record(self, execute, sql, params, many, context):
+        if not SAVEPOINT_RE.match(sql):
+            self.queries.append(CapturedQuery(sql, _stack()))
+        return execute(sql, params, many, context)
+
+    def __len__(self):
+        return len(self.queries)
+
+    @property
+    def duplicates(self):
+        """Число повторов: выполнений запроса сверх первого."""
+        return len(self.queries) - len({query.sql for query in self.queries})
+
+    def overruns(self, budget, title=''):
+        """Описание превышений бюджета с SQL и стеками или пустая строка."""
+        lines = []
+        if len(self.queries) > budget.queries:
+            lines.append(f'{title}: {len(self.queries)} queries, budget {budget.queries}')
+            for number, query in enumerate(self.queries, 1):
+                lines.append(f'{number}. {query.sql}\n{query.stack}')
+        if self.duplicates > budget.duplicates:
+            lines.append(f'{title}: {self.duplicates} duplicate queries, '
+                         f'budget {budget.duplicates}')
+            counts = Counter(query.sql for query in self.queries)
+            for sql, count in counts.items():
+                if count < 2:
+                    continue
+                lines.append(f'{count}x {sql}')
+                stacks = [query.stack for query in self.queries if query.sql == sql]
+                lines.extend(stacks[:DUPLICATE_STACKS])
+        return '\n'.join(lines)
+
+
+@contextmanager
+def enforce_budget(budget, title='', using=DEFAULT_DB_ALIAS):
+    """Выполняет блок и вызывает QueryBudgetExceeded, если запросов
+    или повторов больше, чем разрешает budget. Исключение из блока
+    передается дальше без проверки."""
+    with QueryLog(using) as log:
+        yield log
+    report = log.overruns(budget, title)
+    if report:
+        raise QueryBudgetExceeded(report)
@@ -0,0 +1,109 @@
+"""
+Полнотекстовый поиск по товарам.
+
+PostgreSQL (production): колонка core_item.search_vector типа tsvector
+с GIN индексом, заголовок весит больше описания, сортировка по ts_rank.
+SQLite (development): виртуальная таблица FTS5 core_item_fts,
+сортировка по bm25.
+
+Индекс обновляется сигналами модели Item (см. models.py). Массовые операции
+(bulk_create, update) сигналы не вызывают, после них нужно выполнить
+команду rebuild_search_index.
+"""
+import re
+
+from django.db import connection
+from django.db.models import Q
+
+
+# Конфигурация полнотекстового поиска PostgreSQL.
+POSTGRES_SEARCH_CONFIG = 'russian'
+
+# Вес совпадения в заголовке относительно описания для bm25 в SQLite.
+SQLITE_TITLE_WEIGHT = 10.0
+
+WORD_RE = re.compile(r'\w+')
+
+POSTGRES_VECTOR_SQL = (
+    "setweight(to_tsvector(%s, coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector(%s, coalesce(description, '')), 'B')"
+)
+
+
+def _words(query):
+    return WORD_RE.findall(query or '')[:10]
+
+
+def search_items(queryset, query):
+    """Фильтрует выборку товаров по поисковому запросу
+    и сортирует ее по релевантности."""
+    words = _words(query)
+    if not words:
+        return queryset.none()
+
+    if connection.vendor == 'postgresql':
+        # Каждое слово ищем как префикс, все слова должны присутствовать.
+        tsquery = ' & '.join(f'{word}:*' for word in words)
+        return queryset.extra(
+            select={'rank': 'ts_rank(core_item.search_vector, to_tsquery(%s, %s))'},
+            select_params=(POSTGRES_SEARCH_CONFIG, tsquery),
+            where=['core_item.search_vector @@ to_tsquery(%s, %s)'],
+            params=(POSTGRES_SEARCH_CONFIG, tsquery),
+            order_by=['-rank', '-id'],
+        )
+
+    if connection.vendor == 'sqlite':
+        match = ' '.join(f'"{word}"*' for word in words)
+        return queryset.extra(
+            tables=['core_item_fts'],
+            select={'rank': f'bm25(core_item_fts, {SQLITE_TITLE_WEIGHT}, 1.0)'},
+            where=['core_item_fts.rowid = core_item.id', 'core_item_fts MATCH %s'],
+            params=(match,),
+            order_by=['rank', '-id'],
+        )
+
+    # Остальные СУБД: поиск без индекса.
+    condition = Q()
+    for word in words:
+        condition &= Q(title__icontains=word) | Q(description__icontains=word)
+    return queryset.filter(condition)
+
+
+def index_item(item):
+    """Обновляет запись товара в поисковом индексе."""
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                f'UPDATE core_item SET search_vector = {POSTGRES_VECTOR_SQL} WHERE id = %s',
+                [POSTGRES_SEARCH_CONFIG, POSTGRES_SEARCH_CONFIG, item.pk]
+            )
+        elif connection.vendor == 'sqlite':
+            cursor.execute('DELETE FROM core_item_fts WHERE rowid = %s', [item.pk])
+            cursor.execute(
+                'INSERT INTO core_item_fts (rowid, title, description) VALUES (%s, %s, %s)',
+                [item.pk, item.title, item.description]
+            )
+
+
+def unindex_item(item):
+    """Удаляет товар из поискового индекса."""
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM core_item_fts WHERE rowid = %s', [item.pk])
+
+
+def rebuild_index(schema_editor=None):
+    """Полностью перестраивает поисковый индекс."""
+    conn = schema_editor.connection if schema_editor else connection
+    with conn.cursor() as cursor:
+        if conn.vendor == 'postgresql':
+            cursor.execute(
+                f'UPDATE core_item SET search_vector = {POSTGRES_VECTOR_SQL}',
+                [POSTGRES_SEARCH_CONFIG, POSTGRES_SEARCH_CONFIG]
+            )
+        elif conn.vendor == 'sqlite':
+            cursor.execute('DELETE FROM core_item_fts')
+            cursor.execute(
+                'INSERT INTO core_item_fts (rowid, title, description) '
+                'SELECT id, title, description FROM core_item'
+            )
@@ -1,40 +1,55 @@
+import hashlib
+import logging
 import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 
 import stripe
 from django.conf import settings
-from django.contrib import messages
-from django.shortcuts import redirect
+from django.core.cache import cache
 
-from core.models import Coupon
+from core import stripe_gateway
+from core.cache import LocalCache, versioned_key
+from core.models import Category, Coupon
 
 
-def create_charge_or_error(amount, currency, token=None, customer=None):
+logger = logging.getLogger(__name__)
+
+
+# Категории меняются редко, версия кэша сбрасывается сигналами модели.
+CATEGORIES_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Промокоды: общий кэш сбрасывается сигналами модели, кэш процесса
+# живет несколько секунд и сбрасывается только по времени.
+COUPON_CACHE_TIMEOUT = 60 * 60
+coupons_local_cache = LocalCache(timeout=settings.COUPON_LOCAL_CACHE_TIMEOUT)
+
+# Потоки для запросов к Stripe, которые не должны задерживать ответ страницы.
+stripe_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='stripe')
+
+
+def create_charge_or_error(amount, currency, token=None, customer=None,
+                           idempotency_key=None):
     """Создает соединение с STRIPE API, при успешном
     соединении возвращает экземпляр класса Charge.
-    Если произошла ошибка, то возвращает информацию о ней."""
-
-    stripe.api_key = settings.STRIPE_SECRET_KEY
+    Если произошла ошибка, то возвращает информацию о ней.
+    Повторный вызов с тем же idempotency_key не создает второй платеж."""
 
     try:
-        if customer:
-            charge = stripe.Charge.create(
-                amount=amount,
-                currency=currency,
-                customer=customer,
-            )
-        else:
-            charge = stripe.Charge.create(
-                amount=amount,
-                currency=currency,
-                source=token,
-            )
+        charge = stripe_gateway.create_charge(
+            amount=amount,
+            currency=currency,
+            source=token,
+            customer=customer,
+            idempotency_key=idempotency_key,
+        )
     except stripe.error.CardError as e:
         body = e.json_body
         err = body.get('error', {})
         return f'{err.get("message")}'
 
     except stripe.error.RateLimitError as e:
-        # Too many requests made to the API too quickly
+        # Too many requests made to the API too quickly,
+        # the gateway has already retried it
         return "Время подключения вышло."
 
     except stripe.error.InvalidRequestError as e:
@@ -63,16 +78,98 @@ def create_charge_or_error(amount, currency, token=None, customer=None):
     return charge
 
 
-def get_coupon(request, code):
-    """Возвращает существующий промокод."""
+def refund_charge(charge_id, idempotency_key=None):
+    """Возвращает платеж целиком. Если Stripe вернул ошибку,
+    записывает ее в лог и возвращает False."""
     try:
-        coupon = Coupon.objects.get(code=code)
-        return coupon
-    except Coupon.DoesNotExist:
-        messages.warning(request, 'Данный промокод не найден')
-        return redirect('/')
+        stripe_gateway.create_refund(charge_id, idempotency_key=idempotency_key)
+    except stripe.error.StripeError:
+        logger.exception('Refund of charge %s failed', charge_id)
+        return False
+    return True
+
+
+def _coupon_key(code):
+    # Код вводит пользователь, поэтому в ключ попадает его хэш.
+    return versioned_key('coupons', hashlib.md5(code.encode()).hexdigest())
+
+
+def get_coupon(code):
+    """Возвращает промокод по коду или None. Найденные и ненайденные коды
+    кэшируются в памяти процесса и в общем кэше, поэтому поток неверных
+    кодов не доходит до базы. Кэш сбрасывается при изменении промокодов."""
+    coupon = coupons_local_cache.get(code)
+    if coupon is None:
+        key = _coupon_key(code)
+        coupon = cache.get(key)
+        if coupon is None:
+            # False - промокод не найден.
+            coupon = Coupon.objects.filter(code=code).first() or False
+            cache.set(key, coupon, COUPON_CACHE_TIMEOUT)
+        coupons_local_cache.set(code, coupon)
+    return coupon or None
 
 
 def create_reference_code():
     """Создает уникальный код для модели Order."""
-    return uuid.uuid4().hex
+    return uuid.uuid4().hex[:20]
+
+
+def get_categories():
+    """Возвращает список категорий из общего кэша."""
+    key = versioned_key('categories', 'list')
+    categories = cache.get(key)
+    if categories is None:
+        categories = list(Category.objects.all())
+        cache.set(key, categories, CATEGORIES_CACHE_TIMEOUT)
+    return categories
+
+
+def _saved_card_key(customer_id):
+    return f'stripe:card:{customer_id}'
+
+
+def _fetch_saved_card(customer_id):
+    """Запрашивает у Stripe первую сохраненную карту покупателя."""
+    cards = stripe_gateway.list_cards(customer_id)
+    card_list = cards['data']
+    if not card_list:
+        # Пустой словарь кэшируем, чтобы не спрашивать Stripe снова.
+        return {}
+    card = card_list[0]
+    return {
+        'brand': card['brand'],
+        'last4': card['last4'],
+        'exp_month': card['exp_month'],
+        'exp_year': card['exp_year'],
+    }
+
+
+def _cache_saved_card(customer_id, future):
+    if future.exception() is None:
+        cache.set(_saved_card_key(customer_id), future.result(),
+                  settings.STRIPE_CARD_CACHE_TIMEOUT)
+
+
+def get_saved_card(customer_id):
+    """Возвращает данные сохраненной карты покупателя (brand, last4,
+    exp_month, exp_year) или None. Ответ Stripe кэшируется. Если Stripe не
+    ответил за STRIPE_CARD_LOOKUP_TIMEOUT секунд, страница выводится
+    без карты, а ответ попадет в кэш, когда придет."""
+    card = cache.get(_saved_card_key(customer_id))
+    if card is not None:
+        return card or None
+
+    future = stripe_executor.submit(_fetch_saved_card, customer_id)
+    future.add_done_callback(lambda f: _cache_saved_card(customer_id, f))
+    try:
+        return future.result(timeout=settings.STRIPE_CARD_LOOKUP_TIMEOUT) or None
+    except TimeoutError:
+        return None
+    except stripe.error.StripeError:
+        return None
+
+
+def invalidate_saved_card(customer_id):
+    """Сбрасывает кэш карты после изменения покупателя в Stripe."""
+    cache.delete(_saved_card_key(customer_id))
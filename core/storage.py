@@ -0,0 +1,50 @@
+"""
+Хранилище статики для production.
+
+collectstatic сохраняет файлы с хэшем содержимого в имени (см.
+ManifestStaticFilesStorage) и рядом с каждым текстовым файлом кладет его
+сжатую копию <имя>.gz. nginx отдает статику сам (gzip_static), с хэшем
+в имени - с кэшированием навсегда, и ничего не сжимает при каждом запросе.
+"""
+import gzip
+import os
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+
+
+# Форматы, которые имеет смысл сжимать; изображения и woff уже сжаты.
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.map', '.svg', '.json', '.txt', '.ttf', '.eot', '.otf', '.ico')
+# Файлы меньше этого размера не сжимаются: выигрыш меньше заголовков ответа.
+MIN_COMPRESS_SIZE = 512
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+
+    def post_process(self, paths, dry_run=False, **options):
+        hashed_names = set()
+        for name, hashed_name, processed in super().post_process(paths, dry_run, **options):
+            if hashed_name and not isinstance(processed, Exception):
+                hashed_names.add(hashed_name)
+            yield name, hashed_name, processed
+        if dry_run:
+            return
+        # Сжимаем и исходные имена: на них ссылаются файлы вне шаблонов.
+        for name in hashed_names | set(paths):
+            self._compress(name)
+
+    def _compress(self, name):
+        if not name.endswith(COMPRESSIBLE_EXTENSIONS):
+            return
+        path = self.path(name)
+        size = os.path.getsize(path)
+        compressed_path = path + '.gz'
+        if size < MIN_COMPRESS_SIZE or (
+                os.path.exists(compressed_path)
+                and os.path.getmtime(compressed_path) >= os.path.getmtime(path)):
+            return
+        with open(path, 'rb') as source:
+            data = gzip.compress(source.read(), compresslevel=9, mtime=0)
+        if len(data) < size:
+            with open(compressed_path + '.tmp', 'wb') as target:
+                target.write(data)
+            os.replace(compressed_path + '.tmp', compressed_path)
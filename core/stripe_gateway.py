@@ -0,0 +1,131 @@
+"""
+Обращения к Stripe API.
+
+Все запросы к Stripe проходят через этот модуль. Ключ и адрес API задаются
+один раз при импорте, HTTP-сессия с keep-alive переиспользуется всеми
+потоками, у соединения и чтения ответа есть свои таймауты. Ошибки
+RateLimitError и APIConnectionError повторяются с экспоненциальной задержкой
+и случайным разбросом. Создающие запросы всегда отправляются с ключом
+идемпотентности, поэтому повтор не создаст второй платеж или покупателя.
+Время каждого вызова копится по операциям, см. stats().
+"""
+import logging
+import random
+import threading
+import time
+import uuid
+
+import requests
+import stripe
+from django.conf import settings
+from stripe.http_client import RequestsClient
+
+from core import metrics
+
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_ERRORS = (stripe.error.RateLimitError, stripe.error.APIConnectionError)
+
+_session = requests.Session()
+_adapter = requests.adapters.HTTPAdapter(pool_maxsize=settings.STRIPE_POOL_SIZE)
+_session.mount('https://', _adapter)
+_session.mount('http://', _adapter)
+
+stripe.api_key = settings.STRIPE_SECRET_KEY
+stripe.api_base = settings.STRIPE_API_BASE
+# Повторы делает call(), встроенные повторы библиотеки отключены.
+stripe.max_network_retries = 0
+stripe.default_http_client = RequestsClient(
+    timeout=(settings.STRIPE_CONNECT_TIMEOUT, settings.STRIPE_READ_TIMEOUT),
+    session=_session,
+)
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+def _record(operation, elapsed, failed):
+    with _stats_lock:
+        entry = _stats.setdefault(
+            operation, {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0})
+        entry['count'] += 1
+        entry['errors'] += failed
+        entry['total'] += elapsed
+        entry['max'] = max(entry['max'], elapsed)
+    metrics.observe_stripe(operation, elapsed, failed)
+
+
+def stats():
+    """Возвращает статистику вызовов по операциям:
+    {операция: {count, errors, total, max}}, время в секундах."""
+    with _stats_lock:
+        return {operation: dict(entry) for operation, entry in _stats.items()}
+
+
+def _backoff(attempt):
+    """Задержка перед повтором: случайное значение от нуля
+    до экспоненты, ограниченной STRIPE_RETRY_MAX_DELAY."""
+    ceiling = min(settings.STRIPE_RETRY_MAX_DELAY,
+                  settings.STRIPE_RETRY_BASE_DELAY * 2 ** attempt)
+    return random.uniform(0, ceiling)
+
+
+def call(operation, method, *args, **kwargs):
+    """Вызывает метод библиотеки stripe, замеряет время
+    и повторяет вызов при временных ошибках."""
+    attempt = 0
+    while True:
+        started = time.perf_counter()
+        try:
+            result = method(*args, **kwargs)
+        except RETRYABLE_ERRORS as e:
+            _record(operation, time.perf_counter() - started, failed=True)
+            if attempt >= settings.STRIPE_MAX_RETRIES:
+                raise
+            delay = _backoff(attempt)
+            attempt += 1
+            logger.warning('Stripe %s failed with %s, retry %d in %.2fs',
+                           operation, type(e).__name__, attempt, delay)
+            time.sleep(delay)
+            continue
+        except stripe.error.StripeError:
+            _record(operation, time.perf_counter() - started, failed=True)
+            raise
+        _record(operation, time.perf_counter() - started, failed=False)
+        return result
+
+
+def create_charge(amount, currency, source=None, customer=None, idempotency_key=None):
+    """Списывает оплату с сохраненного покупателя или по токену карты."""
+    payer = {'customer': customer} if customer else {'source': source}
+    return call(
+        'charge.create', stripe.Charge.create,
+        amount=amount, currency=currency,
+        idempotency_key=idempotency_key or uuid.uuid4().hex, **payer
+    )
+
+
+def create_refund(charge_id, idempotency_key=None):
+    """Возвращает платеж целиком."""
+    return call(
+        'refund.create', stripe.Refund.create,
+        charge=charge_id, idempotency_key=idempotency_key or uuid.uuid4().hex
+    )
+
+
+def create_customer(email, source, idempotency_key=None):
+    return call(
+        'customer.create', stripe.Customer.create,
+        email=email, source=source, expand=['sources'],
+        idempotency_key=idempotency_key or uuid.uuid4().hex
+    )
+
+
+def retrieve_customer(customer_id):
+    return call('customer.retrieve', stripe.Customer.retrieve, customer_id)
+
+
+def list_cards(customer_id, limit=3):
+    return call('customer.list_sources', stripe.Customer.list_sources,
+                customer_id, limit=limit, object='card')
@@ -1,14 +1,10 @@
 from django import template
 
-from core.models import Order
-
 register = template.Library()
 
 
 @register.filter
-def cart_item_count(user):
-    if user.is_authenticated:
-        qs = Order.objects.filter(user=user, ordered=False)
-        if qs.exists():
-            return qs[0].items.count()
-    return 0
\ No newline at end of file
+def cart_item_count(request):
+    """Количество позиций в корзине посетителя (см. CartMiddleware)."""
+    cart = getattr(request, 'cart', None)
+    return cart.count() if cart is not None else 0
@@ -0,0 +1,27 @@
+from django import template
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from core import images
+
+register = template.Library()
+
+
+@register.inclusion_tag('inc/responsive_image.html')
+def responsive_image(item, sizes='100vw', css_class='', width=640):
+    """Изображение товара с копиями разной ширины в WebP и JPEG.
+    width - желаемая ширина копии для браузеров без поддержки srcset.
+    Пока копий нет, выводится оригинал, а копии создаются в фоне."""
+    context = {'sizes': sizes, 'css_class': css_class, 'alt': item.title}
+    if not item.image_hash:
+        if item.image:
+            images.schedule_variants(item)
+        context['src'] = item.image.url if item.image else ''
+        return context
+    width = min(settings.IMAGE_VARIANT_WIDTHS, key=lambda w: abs(w - width))
+    context.update({
+        'src': default_storage.url(images.variant_name(item.image_hash, width, 'jpg')),
+        'srcset_webp': images.srcset(item.image_hash, 'webp'),
+        'srcset_jpeg': images.srcset(item.image_hash, 'jpg'),
+    })
+    return context
@@ -3,7 +3,7 @@ from django.urls import path
 from core.views import (
     CheckoutView, HomeView, ItemDetailView,
     add_item_to_cart, remove_from_cart, OrderSummaryView,
-    remove_single_item_from_cart, PaymentView, AddCouponView,
+    remove_single_item_from_cart, PaymentView, PaymentStatusView, AddCouponView,
     ProductsView, RequestRefundView, SearchView
 )
 
@@ -14,6 +14,7 @@ urlpatterns = [
     path('category/<int:id>', ProductsView.as_view(), name='products-by-category'),
     path('search/', SearchView.as_view(), name='search'),
     path('checkout/', CheckoutView.as_view(), name='checkout'),
+    path('payment/status/<key>/', PaymentStatusView.as_view(), name='payment-status'),
     path('payment/<payment_option>/', PaymentView.as_view(), name='payment'),
     path('order-summary/', OrderSummaryView.as_view(), name='order-summary'),
     path('product/<slug>/', ItemDetailView.as_view(), name='product'),
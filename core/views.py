@@ -1,58 +1,87 @@
+import hmac
+
 import stripe
 from django.contrib import messages
-from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.exceptions import ValidationError
 from django.conf import settings
-from django.db.models import Q
+from django.http import Http404, HttpResponse
 from django.shortcuts import render, get_object_or_404, redirect
 from django.views import View
-from django.views.generic import ListView, DetailView, TemplateView
+from django.views.generic import ListView, DetailView
 
-from core.models import Item, Order, Address, Payment, Category, Refund, UserProfile
+from core.models import (
+    Item, Order, Refund, UserProfile, PaymentJob,
+    PAYMENT_JOB_SUCCEEDED, PAYMENT_JOB_FAILED
+)
 from core.forms import CheckoutForm, CouponForm, RefundForm, PaymentForm
-from core.services import create_charge_or_error, get_coupon, create_reference_code
-
-
-stripe.api_key = settings.STRIPE_SECRET_KEY
+from core.pagination import KeysetPaginationMixin, Paginator
+from core.search import search_items
+from core.cache import get_version
+from core.http import ConditionalGetMixin
+from core.query_budget import query_budget
+from core import addresses, cart, inventory, metrics, payment_queue, stripe_gateway
+from core.services import (
+    create_charge_or_error, get_coupon, get_categories,
+    get_saved_card, invalidate_saved_card, refund_charge
+)
+
+
+# Поля товара, которые выводятся в карточке на странице home.html.
+ITEM_CARD_FIELDS = (
+    'id', 'title', 'slug', 'price', 'discount_price',
+    'label', 'image', 'image_hash', 'category', 'category__title',
+)
+
+
+class CategoryNavMixin:
+    """Добавляет в контекст данные для меню категорий в home.html.
+    Список категорий передается функцией и читается из кэша только тогда,
+    когда закэшированный фрагмент меню устарел."""
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['categories'] = get_categories
+        context['categories_version'] = get_version('categories')
+        return context
 
 
-class HomeView(ListView):
+# Бюджеты запросов проверяет команда check_query_budgets.
+@query_budget(queries=5)
+class HomeView(ConditionalGetMixin, CategoryNavMixin, KeysetPaginationMixin, ListView):
     """Основная страница со списком всех товаров на сайте."""
 
     model = Item
     template_name = 'home.html'
-    paginate_by = 1
+    context_object_name = 'items'
+    paginate_by = 12
+    # Список зависит от товаров и названий категорий.
+    validator_versions = ('catalog', 'categories')
 
-    def get_context_data(self, *, object_list=None, **kwargs):
-        return {
-            'items': Item.objects.all(),
-            'categories': Category.objects.all()
-        }
+    def get_queryset(self):
+        return Item.objects.select_related('category').only(*ITEM_CARD_FIELDS)
 
 
-class ProductsView(ListView):
+@query_budget(queries=5)
+class ProductsView(HomeView):
     """Страница с товарами по категориям"""
-    model = Item
-    template_name = 'home.html'
-    paginate_by = 1
-
-    def get_context_data(self, *, object_list=None, **kwargs):
-        category = get_object_or_404(Category, id=self.kwargs.get('id'))
-        items = Item.objects.filter(category=category)
-        return {
-            'items': items,
-            'categories': Category.objects.all()
-        }
+
+    def get_queryset(self):
+        category_id = self.kwargs.get('id')
+        if not any(category.id == category_id for category in get_categories()):
+            raise Http404('Категория не найдена.')
+        return super().get_queryset().filter(category_id=category_id)
 
 
 class CheckoutView(LoginRequiredMixin, View):
     """Вывод страницы с формой для оформления заказа."""""
 
+    @query_budget(queries=6)
     def get(self, *args, **kwargs):
         """Проверяем есть ли у пользователя действительный заказ, сохраненные адреса
         для доставки и выставления счета."""
         try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
+            order = Order.objects.select_related('coupon').get(user=self.request.user, ordered=False)
         except Order.DoesNotExist:
             messages.warning(self.request, 'У вас нет активного заказа. Для начала добавте продукт в корзину.')
             return redirect('core:home')
@@ -62,28 +91,19 @@ class CheckoutView(LoginRequiredMixin, View):
             'form': form,
             'couponform': CouponForm(),
             'order': order,
+            'cart': cart.CartSummary(order),
             'DISPLAY_COUPON_FORM': True
         }
 
-        shipping_address_qs = Address.objects.filter(
-            user=self.request.user,
-            address_type='S',
-            default=True
-        )
-        if shipping_address_qs.exists():
-            context.update(
-                {'default_shipping_address': shipping_address_qs[0]})
-
-        billing_address_qs = Address.objects.filter(
-            user=self.request.user,
-            address_type='B',
-            default=True
-        )
-        if billing_address_qs.exists():
-            context.update(
-                {'default_billing_address': billing_address_qs[0]})
+        # Оба адреса по умолчанию одним запросом или из кэша
+        default_addresses = addresses.get_default_addresses(self.request.user)
+        context.update({
+            'default_shipping_address': default_addresses.get('S'),
+            'default_billing_address': default_addresses.get('B'),
+        })
         return render(self.request, 'checkout.html', context)
 
+    @query_budget(queries=5)
     def post(self, *args, **kwargs):
         """Валидируем форму, сохраняем."""
         try:
@@ -95,8 +115,11 @@ class CheckoutView(LoginRequiredMixin, View):
             return redirect('core:home')
 
         form = CheckoutForm(self.request.POST or None)
-        if form.is_valid():
+        if not form.is_valid():
+            messages.warning(self.request, 'Пожалуйста, проверьте данные формы.')
+            return redirect('core:checkout')
 
+        try:
             if form.cleaned_data['use_default_shipping']:
                 shipping_address = form.set_default_shipping_address(self.request.user, order)
             else:
@@ -108,48 +131,49 @@ class CheckoutView(LoginRequiredMixin, View):
                 form.set_default_billing_address(self.request.user, order)
             else:
                 form.set_new_billing_address(self.request.user, order)
+        except ValidationError as e:
+            messages.warning(self.request, e.message)
+            return redirect('core:checkout')
 
-            # TODO Перенаправляем на страницу по способу оплаты
-            payment_option = form.cleaned_data['payment_option']
-            return redirect('core:payment', payment_option='stripe')
+        # TODO Перенаправляем на страницу по способу оплаты
+        payment_option = form.cleaned_data['payment_option']
+        return redirect('core:payment', payment_option='stripe')
 
 
 class PaymentView(LoginRequiredMixin, View):
     """Вывод страницы с подтверждением оплаты."""
 
+    @query_budget(queries=6)
     def get(self, *args, **kwargs):
         try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
+            order = Order.objects.select_related('coupon').get(user=self.request.user, ordered=False)
         except Order.DoesNotExist:
             messages.warning(self.request, 'У вас нет активного заказа')
             return redirect('/')
-        if order.billing_address:
+        if order.billing_address_id:
             context = {
                 'order': order,
+                'cart': cart.CartSummary(order),
                 'DISPLAY_COUPON_FORM': False,
                 'STRIPE_PUBLIC_KEY': settings.STRIPE_PUBLIC_KEY
             }
             userprofile = self.request.user.userprofile
             # Получаем доступный список платежных карт пользователя
             if userprofile.one_click_purchasing:
-                cards = stripe.Customer.list_sources(
-                    userprofile.stripe_customer_id,
-                    limit=3,
-                    object='card'
-                )
-                card_list = cards['data']
-                if len(card_list) > 0:
+                card = get_saved_card(userprofile.stripe_customer_id)
+                if card:
                     context.update({
-                        'card': card_list[0]
+                        'card': card
                     })
             return render(self.request, 'payment.html', context)
 
         messages.warning(self.request, 'Вы не указали адрес доставки.')
         return redirect('/')
 
+    @query_budget(queries=14)
     def post(self, *args, **kwargs):
         try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
+            order = Order.objects.select_related('coupon').get(user=self.request.user, ordered=False)
         except Order.DoesNotExist:
             messages.warning(self.request, 'У вас нет активного заказа')
             return redirect('/')
@@ -161,27 +185,48 @@ class PaymentView(LoginRequiredMixin, View):
             save = form.cleaned_data.get('save')
             use_default = form.cleaned_data.get('use_default')
             token = form.cleaned_data.get('stripeToken')
+
+            summary = cart.CartSummary(order)
+            # Проверяем и продлеваем резерв товара на время оплаты
+            stock = {line.item_id: line.quantity for line in summary.lines}
+            if not inventory.secure(self.request.user, stock):
+                messages.error(self.request, 'Части товаров из корзины уже нет в наличии.')
+                return redirect('core:order-summary')
+
             # Если пользователь решил сохранить данные об оплате
             if save:
                 if userprofile.stripe_customer_id:
-                    customer = stripe.Customer.retrieve(
+                    customer = stripe_gateway.retrieve_customer(
                         userprofile.stripe_customer_id,
                     )
                 else:
-                    customer = stripe.Customer.create(
+                    customer = stripe_gateway.create_customer(
                         email=self.request.user.email,
                         source=token,
-                        expand=['sources'],
                     )
                     userprofile.stripe_customer_id = customer['id']
                     userprofile.one_click_purchasing = True
                     userprofile.save()
+                invalidate_saved_card(userprofile.stripe_customer_id)
+
+            amount = summary.total
+            if settings.PAYMENT_ASYNC:
+                # Оплату выполнит воркер, пользователь ждет на странице статуса
+                job = payment_queue.enqueue_charge(
+                    order, self.request.user, amount, stock,
+                    token=None if use_default or save else token,
+                    customer=userprofile.stripe_customer_id if use_default or save else None,
+                )
+                if job is None:
+                    messages.warning(self.request, 'Оплата прежнего состава корзины еще '
+                                                   'выполняется, попробуйте через минуту.')
+                    return redirect('core:order-summary')
+                return redirect('core:payment-status', key=job.idempotency_key)
 
-            amount = int(order.get_total())
             # Если используем данные по умолчанию, то передаем Stripe ID пользователя
             if use_default or save:
                 charge = create_charge_or_error(
-                    amount=amount * 100,    # в центах
+                    amount=int(amount * 100),    # в центах
                     currency='usd',
                     customer=userprofile.stripe_customer_id
                 )
@@ -189,23 +234,20 @@ class PaymentView(LoginRequiredMixin, View):
             else:
 
                 charge = create_charge_or_error(
-                    amount=amount * 100,
+                    amount=int(amount * 100),
                     currency='usd',
                     token=token
                 )
             # Если соединение прошло
             if isinstance(charge, stripe.Charge):
-
-                payment = Payment.objects.create(
-                    stripe_charge_id=charge['id'],
-                    user=self.request.user,
-                    amount=amount
-                )
-
-                order.ordered = True
-                order.payment = payment
-                order.reference_code = create_reference_code()
-                order.save()
+                try:
+                    cart.finalize_order(order, self.request.user, charge['id'], amount, stock)
+                except cart.CartChanged:
+                    # Корзину изменили, пока шло списание: оплаченного состава больше нет.
+                    refunded = refund_charge(charge['id'])
+                    messages.error(self.request, cart.CART_CHANGED_REFUNDED if refunded
+                                   else cart.REFUND_FAILED)
+                    return redirect('core:order-summary')
                 messages.success(self.request, 'Успешно')
                 return redirect('/')
 
@@ -214,70 +256,111 @@ class PaymentView(LoginRequiredMixin, View):
             return redirect('/')
 
 
-class OrderSummaryView(LoginRequiredMixin, View):
-    """Вывод страницы с корзиной пользователя."""
+@query_budget(queries=4)
+class PaymentStatusView(LoginRequiredMixin, View):
+    """Страница ожидания асинхронной оплаты заказа."""
+
+    def get(self, *args, **kwargs):
+        job = get_object_or_404(
+            PaymentJob.objects.only('status', 'error'),
+            idempotency_key=kwargs['key'], user=self.request.user
+        )
+        if job.status == PAYMENT_JOB_SUCCEEDED:
+            messages.success(self.request, 'Успешно')
+            return redirect('/')
+        if job.status == PAYMENT_JOB_FAILED:
+            messages.error(self.request, job.error)
+            return redirect('/')
+        return render(self.request, 'payment_processing.html', {'job': job})
+
+
+@query_budget(queries=5)
+class OrderSummaryView(View):
+    """Вывод страницы с корзиной посетителя."""
 
     def get(self, *args, **kwargs):
+        if not self.request.user.is_authenticated:
+            summary = self.request.anonymous_cart.summary()
+            if not summary.count:
+                messages.error(self.request, 'Для начала добавьте товар в корзину')
+                return redirect('/')
+            return render(self.request, 'order_summary.html', {'cart': summary})
+
         try:
-            order = Order.objects.prefetch_related(
-                'items').get(user=self.request.user, ordered=False)
-            return render(self.request, 'order_summary.html', {'object': order})
+            order = Order.objects.select_related('coupon').get(user=self.request.user, ordered=False)
+            return render(self.request, 'order_summary.html', {
+                'object': order,
+                'cart': cart.CartSummary(order)
+            })
 
         except Order.DoesNotExist:
             messages.error(self.request, 'Для начала добавьте товар в корзину')
             return redirect('/')
 
 
-class SearchView(TemplateView):
+@query_budget(queries=6)
+class SearchView(ConditionalGetMixin, CategoryNavMixin, ListView):
     """Вывод страницы с поиском по товарам."""
 
+    model = Item
     template_name = 'home.html'
+    context_object_name = 'items'
+    paginate_by = 12
+    paginator_class = Paginator
+    validator_versions = ('catalog', 'categories')
 
-    def get_context_data(self, *, object_list=None, **kwargs):
-        context = super().get_context_data(**kwargs)
-        search_query = self.request.GET.get('q')
-        try:
-            context['items'] = Item.objects.filter(
-                Q(title__icontains=search_query) | Q(description__icontains=search_query)
-            )
-        except ValueError:
-            context['items'] = None
-        context['categories'] = Category.objects.all()
-        return context
+    def get_queryset(self):
+        queryset = Item.objects.select_related('category').only(*ITEM_CARD_FIELDS)
+        return search_items(queryset, self.request.GET.get('q'))
 
 
-class ItemDetailView(DetailView):
+@query_budget(queries=5)
+class ItemDetailView(ConditionalGetMixin, DetailView):
     """Вывод страницы с информацией о товаре."""
 
     model = Item
     template_name = 'product.html'
     context_object_name = 'item'
 
+    def get_last_modified(self):
+        if not hasattr(self, '_updated_at'):
+            self._updated_at = Item.objects.filter(
+                slug=self.kwargs['slug']).values_list('updated_at', flat=True).first()
+        return self._updated_at
+
+    def get_validator_parts(self):
+        updated_at = self.get_last_modified()
+        return None if updated_at is None else [updated_at.isoformat()]
+
 
-@login_required
+# Повтор - проверка позиции после блокировки заказа (см. cart._add_line).
+@query_budget(queries=10, duplicates=1)
 def add_item_to_cart(request, slug):
-    """Добавляет один товар в корзину пользователя."""
-    item = get_object_or_404(Item, slug=slug)
-    item.add_item_to_cart(request)
+    """Добавляет один товар в корзину посетителя."""
+    # Цены нужны, чтобы зафиксировать их в новой позиции корзины.
+    item = get_object_or_404(
+        Item.objects.only('id', 'quantity', 'price', 'discount_price'), slug=slug)
+    messages.info(request, request.cart.add_item_to_cart(item))
     return redirect(request.META.get('HTTP_REFERER'))
 
 
-@login_required
+@query_budget(queries=8)
 def remove_from_cart(request, slug):
-    """Удаляет позицию товара из корзины пользователя."""
-    item = get_object_or_404(Item, slug=slug)
-    item.remove_item_from_cart(request)
+    """Удаляет позицию товара из корзины посетителя."""
+    item = get_object_or_404(Item.objects.only('id'), slug=slug)
+    messages.info(request, request.cart.remove_item_from_cart(item))
     return redirect(request.META.get('HTTP_REFERER'), slug=slug)
 
 
-@login_required
+@query_budget(queries=9)
 def remove_single_item_from_cart(request, slug):
     """Удаляет из корзины один экземпляр товара."""
-    item = get_object_or_404(Item, slug=slug)
-    item.remove_single_item_from_cart(request)
+    item = get_object_or_404(Item.objects.only('id'), slug=slug)
+    messages.info(request, request.cart.remove_single_item_from_cart(item))
     return redirect(request.META.get('HTTP_REFERER'), slug=slug)
 
 
+@query_budget(queries=5)
 class AddCouponView(LoginRequiredMixin, View):
     """Добавляет скидочный купон к активному заказу пользователя."""
     def post(self, *args, **kwargs):
@@ -291,8 +374,11 @@ class AddCouponView(LoginRequiredMixin, View):
                 return redirect('/')
 
             code = form.cleaned_data.get('code')
-            order.coupon = get_coupon(self.request, code)
-            order.save()
+            coupon = get_coupon(code)
+            if coupon is None:
+                messages.warning(self.request, 'Данный промокод не найден')
+                return redirect('core:checkout')
+            cart.apply_coupon(order, coupon)
             messages.success(self.request, 'Промокод активирован')
             return redirect('core:checkout')
 
@@ -300,10 +386,12 @@ class AddCouponView(LoginRequiredMixin, View):
 class RequestRefundView(LoginRequiredMixin, View):
     """Вывод страницы для заполнения формы возврата."""
 
+    @query_budget(queries=3)
     def get(self, *args, **kwargs):
         form = RefundForm()
         return render(self.request, 'request_refund.html', {'form': form})
 
+    @query_budget(queries=5)
     def post(self, *args, **kwargs):
         form = RefundForm(self.request.POST)
         if form.is_valid():
@@ -316,8 +404,7 @@ class RequestRefundView(LoginRequiredMixin, View):
                 messages.warning(self.request, 'Такого заказа не существует')
                 return redirect('core:request-refund')
 
-            order.refund_requested = True
-            order.save()
+            Order.objects.filter(pk=order.pk).update(refund_requested=True)
 
             refund = Refund.objects.create(
                 order=order,
@@ -330,3 +417,16 @@ class RequestRefundView(LoginRequiredMixin, View):
 
         messages.warning(self.request, 'Ошибка валидации')
         return redirect('core:request-refund')
+
+
+def prometheus_metrics(request):
+    """Метрики Prometheus всех процессов (см. core/metrics.py).
+    Доступны с заголовком Authorization: Bearer METRICS_TOKEN."""
+    if not settings.METRICS_TOKEN:
+        raise Http404
+    expected = f'Bearer {settings.METRICS_TOKEN}'
+    if not hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', '').encode(), expected.encode()):
+        response = HttpResponse(status=401)
+        response['WWW-Authenticate'] = 'Bearer'
+        return response
+    return HttpResponse(metrics.export(), content_type=metrics.CONTENT_TYPE)
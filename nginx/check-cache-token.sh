@@ -0,0 +1,7 @@
+#!/bin/sh
+# Без токена ключ "" в map $catalog_refresh совпал бы с любым запросом
+# без заголовка X-Cache-Refresh, и микрокэш не работал бы.
+if [ -z "$CACHE_REFRESH_TOKEN" ]; then
+    echo "CACHE_REFRESH_TOKEN is not set, refusing to start nginx" >&2
+    exit 1
+fi